@@ -1 +1,4 @@
 from .hmm import HMM
+from .online import OnlineFilter
+from .bank import HMMBank
+from .store import ModelCache
@@ -0,0 +1,135 @@
+"""Batched scoring of a bank of HMMs, e.g. one model per class.
+
+The parameters of the models are stacked, so that a batch of sequences is
+scored against all the models in a single vectorized NumPy pass: the
+emissions of all the states of all the models are evaluated together and
+the forward recursions of all the models advance together.
+"""
+import numpy as np
+from . import numpy_backend
+from . import sources
+
+
+class HMMBank(object):
+  """A bank of HMMs with the same data dimensionality, scored together.
+
+  Models with fewer states are padded with states that are never visited.
+  The bank keeps a copy of the parameters of the models and runs in NumPy,
+  whatever the backend of the models.
+  """
+
+  def __init__(self, models):
+    """Init method of the HMMBank class.
+
+    Args:
+      models: A list of HMM instances with the same data_dim.
+    """
+    if len(models) == 0:
+      raise ValueError('the bank needs at least one model')
+    if len(set(model._data_dim for model in models)) > 1:
+      raise ValueError('all the models must have the same data_dim')
+    num_models = len(models)
+    num_states = max(model._num_states for model in models)
+    data_dim = models[0]._data_dim
+    # the covariances are stacked as variances if they are all diagonal,
+    # and as full matrices otherwise
+    if set(model._covariance_type for model in models) <= {'diag', 'spherical'}:
+      self._covariance_type = 'diag'
+      sigma = np.ones((num_models, num_states, data_dim))
+    else:
+      self._covariance_type = 'full'
+      sigma = np.zeros((num_models, num_states, data_dim, data_dim))
+      sigma[...] = np.identity(data_dim)
+    self._banded = num_states > 1 and all(
+      model._banded and model._num_states == num_states for model in models)
+    self._p0 = np.zeros((num_models, num_states))
+    self._tp = np.zeros((num_models, num_states, num_states))
+    mu = np.zeros((num_models, num_states, data_dim))
+    self._valid = np.zeros((num_models, num_states), dtype=bool)
+    for m, model in enumerate(models):
+      k = model._num_states
+      self._p0[m, :k] = np.reshape(model._p0, (-1,))
+      self._tp[m, :k, :k] = model._tp
+      mu[m, :k] = model._mu
+      if self._covariance_type == 'diag':
+        sigma[m, :k] = np.diagonal(model.sigma, axis1=-2, axis2=-1)
+      else:
+        sigma[m, :k] = model.sigma
+      self._valid[m, :k] = True
+    # the states of all the models are factorized once
+    self._mu = np.reshape(mu, (num_models * num_states, data_dim))
+    self._factors = numpy_backend.gaussian_factors(
+      np.reshape(sigma, (num_models * num_states,) + sigma.shape[2:]),
+      self._covariance_type)
+
+  @property
+  def num_models(self):
+    return self._p0.shape[0]
+
+  def score(self, data, lengths=None, batch_size=None):
+    """Calculates the log-likelihood of every sequence under every model.
+
+    Args:
+      data: A numpy array with rank two or three, a list of rank two arrays
+        of variable lengths, or a rank two array of concatenated sequences.
+      lengths: None or the lengths of the concatenated sequences in data.
+      batch_size: None or the maximum number of sequences that are scored
+        at once, 64 by default.
+
+    Returns:
+      A numpy array of shape (models, sequences).
+    """
+    if lengths is None and not isinstance(data, (list, tuple)):
+      data = np.asarray(data, dtype=np.float64)
+      sequences = list(data[np.newaxis] if data.ndim == 2 else data)
+    else:
+      sequences = sources.split_sequences(data, lengths)
+    log_likelihood = np.empty((self.num_models, len(sequences)))
+    for idx, batch, mask in sources.buckets(sequences, batch_size):
+      log_likelihood[:, idx] = self._score_batch(batch, mask)
+    return log_likelihood
+
+  def argmax(self, data, lengths=None, batch_size=None):
+    """Returns the index of the most likely model of every sequence.
+
+    Args:
+      data, lengths, batch_size: As in score.
+
+    Returns:
+      A numpy array of shape (sequences,).
+    """
+    return np.argmax(self.score(data, lengths, batch_size), axis=0)
+
+  def top_k(self, data, k, lengths=None, batch_size=None):
+    """Returns the k most likely models of every sequence.
+
+    Args:
+      data, lengths, batch_size: As in score.
+      k: The number of models per sequence.
+
+    Returns:
+      The indices of the models, shape (sequences, k), in decreasing order
+      of log-likelihood, and their log-likelihoods, shape (sequences, k).
+    """
+    log_likelihood = self.score(data, lengths, batch_size).T
+    k = min(k, self.num_models)
+    idx = np.argpartition(-log_likelihood, k - 1, axis=-1)[:, :k]
+    top = np.take_along_axis(log_likelihood, idx, axis=-1)
+    order = np.argsort(-top, axis=-1, kind='stable')
+    return (np.take_along_axis(idx, order, axis=-1),
+            np.take_along_axis(top, order, axis=-1))
+
+  def _score_batch(self, batch, mask):
+    num_seq, length, _ = batch.shape
+    num_models, num_states = self._p0.shape
+    log_em = numpy_backend.log_emissions(batch, self._mu, None, self._factors)
+    if mask is not None:
+      log_em *= np.expand_dims(mask, -1)
+    log_em = np.reshape(log_em, (num_seq, length, num_models, num_states))
+    # the padding states are never visited
+    log_em[:, :, ~self._valid] = -np.inf
+    em, shift = numpy_backend.scaled_emissions(log_em)
+    # em shape : (I, models, N, states), c shape : (N, I, models)
+    _, c = numpy_backend.forward(
+      np.transpose(em, (0, 2, 1, 3)), self._p0, self._tp, mask, self._banded)
+    return (np.sum(np.log(c), axis=0) + np.sum(shift, axis=1)).T
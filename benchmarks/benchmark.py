@@ -0,0 +1,293 @@
+"""Benchmark suite of the HMM class.
+
+Times HMM.fit, posterior, run_viterbi and generate on synthetic data that is
+generated by a random model, sweeping the sequence length, the number of
+sequences, the number of states, the data dimension, the hmm_type and the
+backend. Every case runs in its own subprocess, so that its peak resident
+memory is measured in isolation. The results are written as JSON.
+
+Usage:
+  python benchmarks/benchmark.py run --output results.json
+  python benchmarks/benchmark.py run --quick --backends numpy
+  python benchmarks/benchmark.py compare baseline.json results.json
+
+By default every swept parameter varies around the base case while the
+other parameters keep their base value; --grid runs the full product.
+compare exits with status 1 if a case got slower than --threshold times
+its baseline wall time.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+OPERATIONS = ('fit', 'posterior', 'run_viterbi', 'generate')
+
+BACKENDS = ('tensorflow', 'numpy')
+
+BASE_CASE = {'length': 100, 'batch_size': 32, 'num_states': 4, 'data_dim': 4,
+             'hmm_type': 'fully-connected'}
+
+# the fields that identify a case in the results
+CASE_KEYS = sorted(BASE_CASE) + ['backend', 'operation']
+
+SWEEP = {'length': [50, 200, 1000],
+         'batch_size': [8, 32, 128],
+         'num_states': [2, 8, 32],
+         'data_dim': [2, 8, 32],
+         'hmm_type': ['fully-connected', 'left-to-right', 'cyclic']}
+
+QUICK_SWEEP = {'length': [50, 200],
+               'batch_size': [8, 32],
+               'num_states': [2, 8],
+               'data_dim': [2, 8],
+               'hmm_type': ['fully-connected', 'left-to-right']}
+
+
+def synthetic_data(case, seed=0):
+  """Generates the sequences of a case with a random model.
+
+  Args:
+    case: A dict with the length, batch_size, num_states, data_dim and
+      hmm_type of the case.
+    seed: The random seed.
+
+  Returns:
+    A numpy array of shape (batch_size, length, data_dim) and the
+    parameters p0, tp, mu, sigma of the model that generated it.
+  """
+  from kesmarag.ml.hmm import HMM
+  rng = np.random.RandomState(seed)
+  model = HMM(case['num_states'], case['data_dim'], case['hmm_type'],
+              backend='numpy')
+  model._mu = 3.0 * rng.randn(case['num_states'], case['data_dim'])
+  if case['hmm_type'] == 'fully-connected':
+    tp = rng.rand(case['num_states'], case['num_states']) + 1.0
+    model._tp = tp / np.sum(tp, axis=1, keepdims=True)
+  data, _ = model.generate(case['length'], case['batch_size'], seed=seed)
+  return data, (model._p0, model._tp, model._mu, model._sigma)
+
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    rss /= 1024.0
+  return rss / 1024.0
+
+
+def run_case(case, repeats=3, fit_steps=5):
+  """Runs a single case in the current process.
+
+  The first call of an operation includes the construction of the graph
+  and is reported apart from the median wall time of the next repeats.
+
+  Args:
+    case: A dict with the parameters of the case and its operation.
+    repeats: The number of timed calls after the first one.
+    fit_steps: The number of EM steps of fit.
+
+  Returns:
+    A dict with the case, its timings, throughput and peak RSS.
+  """
+  from kesmarag.ml.hmm import HMM
+  data, params = synthetic_data(case)
+  rss_data = peak_rss_mb()
+  model = HMM(case['num_states'], case['data_dim'], case['hmm_type'],
+              backend=case['backend'])
+  frames = case['batch_size'] * case['length']
+  if case['operation'] == 'fit':
+    frames *= fit_steps
+
+    def call():
+      # TOL=0 runs all the steps
+      model.fit(data, max_steps=fit_steps, TOL=0.0, seed=0)
+  else:
+    # the generating model, so that the numpy backend never imports
+    # TensorFlow
+    model._p0, model._tp, model._mu, model._sigma = params
+    model._epoch = 1
+    model._params_version += 1
+    if case['operation'] == 'posterior':
+      call = lambda: model.posterior(data)
+    elif case['operation'] == 'run_viterbi':
+      call = lambda: model.run_viterbi(data)
+    else:
+      call = lambda: model.generate(case['length'], case['batch_size'])
+  times = []
+  for _ in range(repeats + 1):
+    tic = time.time()
+    call()
+    times.append(time.time() - tic)
+  wall_time = float(np.median(times[1:]))
+  result = dict(case)
+  result.update({'first_call_time': times[0],
+                 'wall_time': wall_time,
+                 'frames_per_sec': frames / wall_time,
+                 'peak_rss_mb': peak_rss_mb(),
+                 'data_rss_mb': rss_data})
+  return result
+
+
+def cases(sweep, backends=BACKENDS, grid=False, operations=OPERATIONS):
+  """Lists the cases of a sweep.
+
+  Args:
+    sweep: A dict from the parameters of BASE_CASE to lists of values.
+    backends: The backends, every case runs on each of them.
+    grid: If True, the full product of the values, otherwise every
+      parameter varies around BASE_CASE.
+    operations: The operations to run for every case.
+
+  Returns:
+    A list of dicts, one per case, backend and operation.
+  """
+  if grid:
+    keys = sorted(sweep)
+    points = [dict(zip(keys, values))
+              for values in itertools.product(*[sweep[k] for k in keys])]
+  else:
+    points = []
+    for key in sorted(sweep):
+      for value in sweep[key]:
+        point = dict(BASE_CASE)
+        point[key] = value
+        if point not in points:
+          points.append(point)
+  result = []
+  for point in points:
+    for backend in backends:
+      for operation in operations:
+        # fit always trains with TensorFlow
+        if operation == 'fit' and backend != 'tensorflow':
+          continue
+        case = dict(point)
+        case['backend'] = backend
+        case['operation'] = operation
+        result.append(case)
+  return result
+
+
+def environment():
+  # the software and hardware that produced the results
+  env = {'python': platform.python_version(), 'numpy': np.__version__,
+         'platform': platform.platform(), 'processor': platform.processor(),
+         'cpu_count': os.cpu_count(),
+         'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+  try:
+    env['commit'] = subprocess.check_output(
+      ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+      cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    env['commit'] = None
+  return env
+
+
+def run(args):
+  sweep = dict(QUICK_SWEEP if args.quick else SWEEP)
+  if args.hmm_types:
+    sweep['hmm_type'] = args.hmm_types
+  results = []
+  todo = cases(sweep, args.backends, args.grid, args.operations)
+  for i, case in enumerate(todo):
+    # a new process per case, so that the peak RSS is of this case only
+    proc = subprocess.run(
+      [sys.executable, os.path.abspath(__file__), 'case', json.dumps(case),
+       '--repeats', str(args.repeats), '--fit-steps', str(args.fit_steps)],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode == 0:
+      result = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+    else:
+      result = dict(case)
+      result['error'] = proc.stderr.decode().strip().splitlines()[-1:]
+    results.append(result)
+    print('[%d/%d] %s' % (i + 1, len(todo), format_result(result)))
+    sys.stdout.flush()
+  with open(args.output, 'w') as f:
+    json.dump({'environment': environment(), 'results': results}, f,
+              indent=2)
+  print('results written to ' + args.output)
+
+
+def case_key(result):
+  return tuple(result[k] for k in CASE_KEYS)
+
+
+def format_result(result):
+  case = ' '.join('%s=%s' % (k, result[k]) for k in CASE_KEYS)
+  if 'error' in result:
+    return case + ' error: ' + ' '.join(result['error'])
+  return case + ' wall_time=%.4fs frames/sec=%.0f peak_rss=%.0fMB' % (
+    result['wall_time'], result['frames_per_sec'], result['peak_rss_mb'])
+
+
+def compare(args):
+  with open(args.baseline) as f:
+    baseline = {case_key(r): r for r in json.load(f)['results']
+                if 'error' not in r}
+  with open(args.results) as f:
+    results = [r for r in json.load(f)['results'] if 'error' not in r]
+  regressions = 0
+  for result in results:
+    base = baseline.get(case_key(result))
+    if base is None:
+      continue
+    ratio = result['wall_time'] / base['wall_time']
+    rss_ratio = result['peak_rss_mb'] / base['peak_rss_mb']
+    flag = ''
+    if ratio > args.threshold:
+      flag = '  <- slower'
+      regressions += 1
+    print('%s time x%.2f rss x%.2f%s' % (
+      ' '.join(str(v) for v in case_key(result)), ratio, rss_ratio, flag))
+  print('%d regressions above x%.2f' % (regressions, args.threshold))
+  return 1 if regressions else 0
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  subparsers = parser.add_subparsers(dest='command')
+  parser_run = subparsers.add_parser('run', help='runs the benchmark suite')
+  parser_run.add_argument('--output', default='benchmark_results.json')
+  parser_run.add_argument('--quick', action='store_true',
+                          help='a smaller sweep')
+  parser_run.add_argument('--grid', action='store_true',
+                          help='the full product of the swept values')
+  parser_run.add_argument('--backends', nargs='+', choices=BACKENDS,
+                          default=list(BACKENDS))
+  parser_run.add_argument('--hmm-types', nargs='+',
+                          choices=['fully-connected', 'left-to-right',
+                                   'cyclic'])
+  parser_run.add_argument('--operations', nargs='+', choices=OPERATIONS,
+                          default=list(OPERATIONS))
+  parser_run.add_argument('--repeats', type=int, default=3)
+  parser_run.add_argument('--fit-steps', type=int, default=5)
+  parser_case = subparsers.add_parser('case', help='runs a single case')
+  parser_case.add_argument('case', help='the case as JSON')
+  parser_case.add_argument('--repeats', type=int, default=3)
+  parser_case.add_argument('--fit-steps', type=int, default=5)
+  parser_compare = subparsers.add_parser(
+    'compare', help='compares the wall times of two result files')
+  parser_compare.add_argument('baseline')
+  parser_compare.add_argument('results')
+  parser_compare.add_argument('--threshold', type=float, default=1.2)
+  args = parser.parse_args()
+  if args.command == 'run':
+    run(args)
+  elif args.command == 'case':
+    print(json.dumps(run_case(json.loads(args.case), args.repeats,
+                              args.fit_steps)))
+  elif args.command == 'compare':
+    sys.exit(compare(args))
+  else:
+    parser.print_help()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,15 +1,197 @@
+import collections
 import os
 import shutil
+import sys
 import tempfile
 import time
 import numpy as np
-import tensorflow as tf
 from kesmarag.ml.utils import DataSet
-from sklearn.cluster import KMeans
-from tensorflow.contrib.distributions import MultivariateNormalFullCovariance
+from . import numpy_backend
+from . import sources
+from . import store
+from .online import OnlineFilter
 
-# disable the tensorflow's warnings
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+# TensorFlow is imported on first use, see _import_tensorflow
+tf = None
+
+BACKENDS = ('tensorflow', 'numpy')
+COVARIANCE_TYPES = ('full', 'diag', 'spherical', 'tied')
+RECURSIONS = ('auto', 'sequential', 'scan')
+DTYPES = ('float64', 'float32')
+
+# The associative scans cost O(states^3) per frame instead of O(states^2),
+# in O(log N) sequential steps instead of N. With recursion='auto' they run
+# on batches of at least SCAN_MIN_LENGTH frames per sequence, with at most
+# SCAN_MAX_WORK sequences times states^3 and SCAN_MAX_ENTRIES operator
+# entries (sequences x frames x states^2).
+SCAN_MIN_LENGTH = 1000
+SCAN_MAX_WORK = 512
+SCAN_MAX_ENTRIES = 2 ** 24
+
+
+def _import_tensorflow():
+  """Imports TensorFlow, which is needed only by the tensorflow backend
+     and by the fit method. The numpy backend never calls this function.
+  """
+  global tf
+  if tf is None:
+    # disable the tensorflow's warnings
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    import tensorflow
+    tf = tensorflow
+  return tf
+
+
+def _num_cpus():
+  # the CPU cores available to this process
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+def _peak_rss_mb():
+  # the memory high-water mark of this process, None if not available
+  try:
+    import resource
+  except ImportError:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on Linux and bytes on macOS
+  return rss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+# the model and the training arguments of a worker process of the
+# parallel training, see HMM._parallel_fit_runs
+_fit_worker_state = {}
+
+
+def _init_fit_worker(config, fit_args):
+  num_states, data_dim, hmm_type, covariance_type, recursion, dtype, \
+      num_threads = config
+  model = HMM(num_states, data_dim, hmm_type, covariance_type=covariance_type,
+              recursion=recursion, dtype=dtype)
+  model._session_config = tf.ConfigProto(
+    intra_op_parallelism_threads=num_threads,
+    inter_op_parallelism_threads=num_threads)
+  _fit_worker_state['model'] = model
+  _fit_worker_state['fit_args'] = fit_args
+
+
+def _fit_worker(r, seed):
+  model = _fit_worker_state['model']
+  return model._fit_run(r, seed, *_fit_worker_state['fit_args'])
+
+
+# the model, session, parameter block and data of a worker process of the
+# sharded expectation step, see _ShardedEStep
+_e_step_worker_state = {}
+
+
+def _init_e_step_worker(config, params_name, params_shapes, data, num_shards,
+                        chunk_size):
+  from multiprocessing import shared_memory
+  num_states, data_dim, hmm_type, covariance_type, recursion, dtype, \
+      num_threads = config
+  model = HMM(num_states, data_dim, hmm_type, covariance_type=covariance_type,
+              recursion=recursion, dtype=dtype)
+  model._session_config = tf.ConfigProto(
+    intra_op_parallelism_threads=num_threads,
+    inter_op_parallelism_threads=num_threads)
+  sess = tf.Session(graph=model._graph, config=model._session_config)
+  sess.run(model._init_op)
+  _e_step_worker_state.update({
+    'model': model, 'session': sess,
+    'params': shared_memory.SharedMemory(name=params_name),
+    'params_shapes': params_shapes, 'data': data, 'num_shards': num_shards,
+    'chunk_size': chunk_size})
+
+
+def _e_step_worker(kind, shard):
+  # the statistics, or the sum of the log-likelihoods and the number of
+  # sequences, of a shard of the training or validation data
+  state = _e_step_worker_state
+  model = state['model']
+  model._p0, model._tp, model._mu, model._sigma = _shared_params(
+    state['params'], state['params_shapes'], copy=True)
+  model._params_version += 1
+  chunks = state['data'][kind].shard(shard, state['num_shards']).chunks(
+    state['chunk_size'])
+  if kind == 'train':
+    return model._accumulate_statistics(state['session'], chunks)
+  return model._posterior_sum(state['session'], chunks)
+
+
+def _shared_params(block, shapes, copy=False):
+  # the parameters p0, tp, mu, sigma laid out one after the other in a
+  # shared memory block of float64
+  params = []
+  offset = 0
+  for shape in shapes:
+    param = np.ndarray(shape, dtype=np.float64, buffer=block.buf, offset=offset)
+    params.append(np.copy(param) if copy else param)
+    offset += param.nbytes
+  return params
+
+
+class _ShardedEStep(object):
+  """The expectation step of fit over shards of the sequences, in a pool of
+     worker processes with a graph each. The parameters reach the workers
+     through a shared memory block at every step and the workers send back
+     only the sufficient statistics of their shard, which are summed here.
+  """
+
+  def __init__(self, model, num_shards, source, validation, chunk_size):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    self._num_shards = num_shards
+    self._shapes = [np.shape(model._p0), np.shape(model._tp),
+                    np.shape(model._mu), np.shape(model._sigma)]
+    self._block = shared_memory.SharedMemory(
+      create=True, size=8 * sum(int(np.prod(shape)) for shape in self._shapes))
+    num_threads = max(1, _num_cpus() // num_shards)
+    config = (model._num_states, model._data_dim, model._hmm_type,
+              model._covariance_type, model._recursion, model._dtype,
+              num_threads)
+    data = {'train': source, 'validation': validation or source}
+    self._pool = ProcessPoolExecutor(
+      max_workers=num_shards, mp_context=multiprocessing.get_context('spawn'),
+      initializer=_init_e_step_worker,
+      initargs=(config, self._block.name, self._shapes, data, num_shards,
+                chunk_size))
+
+  def statistics(self, model):
+    """Returns the statistics of all the shards with the parameters of the
+       model, as HMM._accumulate_statistics.
+    """
+    stats = None
+    for shard_stats in self._map(model, 'train'):
+      if stats is None:
+        stats = shard_stats
+      elif shard_stats is not None:
+        for key in stats:
+          stats[key] += shard_stats[key]
+    return stats
+
+  def mean_posterior(self, model):
+    """Returns the mean log-likelihood of the validation data, or of the
+       training data if there is none.
+    """
+    sums = self._map(model, 'validation')
+    return sum(total for total, _ in sums) / sum(num for _, num in sums)
+
+  def close(self):
+    self._pool.shutdown()
+    self._block.close()
+    self._block.unlink()
+
+  def _map(self, model, kind):
+    # the parameters are not written again before all the shards are done
+    for param, value in zip(_shared_params(self._block, self._shapes),
+                            (model._p0, model._tp, model._mu, model._sigma)):
+      param[...] = value
+    return list(self._pool.map(
+      _e_step_worker, [kind] * self._num_shards, range(self._num_shards)))
 
 
 class HMM(object):
@@ -20,31 +202,90 @@ class HMM(object):
      The class is licensed under the MIT License.
   """
 
-  def __init__(self, num_states, data_dim, hmm_type='fully-connected'):
+  def __init__(self, num_states, data_dim, hmm_type='fully-connected',
+               backend='tensorflow', covariance_type='full', recursion='auto',
+               dtype='float64'):
     """Init method of the HMM class.
     Args:
       num_states: Number of the hidden states.
       data_dim: Dimensionality of the observed data.
-      hmm_type: Type of HMM (fully-connected, left-to-right, cyclic).
+      hmm_type: Type of HMM (fully-connected, left-to-right, cyclic). The
+        left-to-right and cyclic transitions are banded, so every forward,
+        backward and viterbi step and the transition statistics cost
+        O(num_states) per frame instead of O(num_states^2).
+      backend: The inference backend (tensorflow, numpy). The numpy backend
+        runs posterior, run_viterbi and generate without TensorFlow, which
+        is then imported and its graph built only if fit is called.
+      covariance_type: The form of the covariances of the states (full,
+        diag, spherical, tied). A diagonal or spherical covariance costs
+        O(dim) per frame and state, instead of O(dim^2), and tied states
+        share a single full covariance.
+      recursion: How the forward, backward and viterbi recursions run over
+        time (auto, sequential, scan). A scan is an associative prefix
+        product of per-frame operators, in O(log N) sequential steps but
+        O(num_states^3) work per frame, for few long sequences. auto uses
+        the scans only in that case, see SCAN_MIN_LENGTH.
+      dtype: The precision of the inference (float64, float32). The
+        emissions are evaluated in log-space and shifted by their maximum
+        over the states, so float32 does not underflow. It halves the
+        memory of the per-frame arrays, while the log-likelihoods, the
+        statistics of fit, the viterbi scores and the parameters stay in
+        float64.
     """
-    self._dir = tempfile.mkdtemp()
+    if backend not in BACKENDS:
+      raise ValueError('backend must be one of ' + ', '.join(BACKENDS))
+    if covariance_type not in COVARIANCE_TYPES:
+      raise ValueError(
+        'covariance_type must be one of ' + ', '.join(COVARIANCE_TYPES))
+    if recursion not in RECURSIONS:
+      raise ValueError('recursion must be one of ' + ', '.join(RECURSIONS))
+    if dtype not in DTYPES:
+      raise ValueError('dtype must be one of ' + ', '.join(DTYPES))
+    self._backend = backend
+    self._recursion = recursion
+    self._dtype = dtype
+    self._covariance_type = covariance_type
+    self._dir = None
     self._epoch = 0
-    self._graph = tf.Graph()
+    self._graph = None
+    self._history = None
+    # serving mode state (see serve / close)
+    self._session = None
+    self._session_config = None
+    self._params_version = 0
+    self._uploaded_version = -1
+    self._upload_ops = []
+    self._upload_feeds = []
+    # the factors of the covariances of a parameter version
+    self._factors = None
+    self._factors_version = -1
     self._num_states = num_states
     self._data_dim = data_dim
     self._hmm_type = hmm_type
-    self._em_probs = self._emission_probs_family()
+    # the left-to-right and cyclic transitions are banded, every step of the
+    # recursions costs O(states) instead of O(states^2). A single state
+    # stays and moves to itself, so its band would count tp twice.
+    self._banded = (hmm_type in ('left-to-right', 'cyclic') and
+                    num_states > 1)
     # numpy variables
     self._p0, self._tp = self._init_p0_tp()
     self._mu = np.random.rand(self._num_states, self._data_dim)
-    self._sigma = np.array(
-      [np.identity(self._data_dim, dtype=np.float64)] * self._num_states)
-    # creation of the computation graph
-    self._create_the_computational_graph()
+    self._sigma = self._diag_covariances(
+      np.ones((self._num_states, self._data_dim), dtype=np.float64))
+    if self._backend == 'tensorflow':
+      self._ensure_graph()
 
   def __del__(self):
-    # delete the tmp directory
-    shutil.rmtree(self._dir)
+    # release the serving session and delete the tmp directory
+    self.close()
+    if getattr(self, '_dir', None) is not None:
+      shutil.rmtree(self._dir)
+
+  def __enter__(self):
+    return self.serve()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
 
   def __str__(self):
     frame_len = 35
@@ -54,6 +295,7 @@ class HMM(object):
     s += '\n' + '-' * frame_len + '\n'
     s += ' - number of states: ' + str(self._num_states) + '\n'
     s += ' - observation length: ' + str(self._data_dim) + '\n'
+    s += ' - covariance type: ' + self._covariance_type + '\n'
     s += ' - training epoch: ' + str(self._epoch)
     if self._epoch > 0:
       s += '\n' + '-' * frame_len + '\n'
@@ -76,225 +318,396 @@ class HMM(object):
     s += '\n' + '-' * frame_len + '\n'
     return s
 
-  def posterior(self, data):
+  def posterior(self, data, lengths=None):
     """Runs the forward-backward algorithm in order to calculate
        the log-scale posterior probabilities.
 
     Args:
-      data: A numpy array with rank two or three.
+      data: A numpy array with rank two or three, a list of rank two arrays
+        of variable lengths, or a rank two array of concatenated sequences.
+      lengths: None or the lengths of the concatenated sequences in data.
 
     Returns:
       A numpy array that contains the log-scale posterior probabilities of
       each time serie in data.
 
     """
-    dataset = DataSet(data, shuffle=False)
-    with tf.Session(graph=self._graph) as sess:
-      sess.run(tf.global_variables_initializer())
-      feed_dict = {
-        self._dataset_tf: dataset.data, self._p0_tf: self._p0,
-        self._tp_tf: self._tp, self._mu_tf: self._mu,
-        self._sigma_tf: self._sigma}
-      return np.squeeze(sess.run(self._posterior, feed_dict=feed_dict))
+    if lengths is None and not isinstance(data, (list, tuple)):
+      dataset = DataSet(data, shuffle=False)
+      return np.squeeze(self._posterior_batch(dataset.data, None))
+    # variable-length sequences are scored in buckets of similar lengths
+    sequences = sources.split_sequences(data, lengths)
+    post = np.empty((len(sequences),))
+    for idx, batch, mask in sources.buckets(sequences):
+      post[idx] = self._posterior_batch(batch, mask)
+    return post
 
   def fit(self, data, max_steps=100, batch_size=None, TOL=0.01, min_var=0.1,
-          num_runs=1):
+          num_runs=1, chunk_size=None, lengths=None, n_jobs=1, seed=None,
+          eval_every=None, validation_data=None, rtol=None, callback=None,
+          e_step_jobs=1, stepwise=False, step_size=0.7):
     """Implements the Baum-Welch fitting algorithm.
 
+    The expectation step runs chunk by chunk and only the sufficient
+    statistics are accumulated before the maximization step, so the peak
+    memory is bounded by the chunk size and not by the size of the data.
+    The log-likelihood that selects the best parameters comes from the same
+    forward pass as the statistics, so every step costs a single pass over
+    the (mini-)batch unless eval_every is set. The initial means come from
+    a single mini-batch k-means++ on a uniform sample of the frames of the
+    whole data, perturbed for every realization.
+
     Args:
-      data: A numpy array with rank two or three.             
+      data: A numpy array with rank two or three, a memory-mapped array,
+        a list of rank two arrays of variable lengths, a rank two array of
+        concatenated sequences, a path or a list of paths to .npy shards,
+        or a callable that returns a new iterator of such chunks at every
+        call.
       max_steps: Maximum number of steps.
       batch_size: None or the number of batch size.
       TOL: The tolerance for stoping the training process.
       min_var: Minimum variance
       num_runs: Number of training realizations. 
       The best of all model is to be kept.
+      chunk_size: None or the maximum number of sequences per chunk of the
+        expectation step. None processes every array or shard at once, and
+        variable-length sequences in buckets of 64 sequences.
+      lengths: None or the lengths of the concatenated sequences in data.
+      n_jobs: Maximum number of training realizations that run at the same
+        time, each in its own worker process. None uses one worker per CPU
+        core. The CPU cores are shared evenly among the workers.
+      seed: None or the base random seed. The initialization is seeded with
+        seed and realization r with seed + r, so the result does not depend
+        on n_jobs.
+      eval_every: None or a number of steps. Every eval_every steps the mean
+        log-likelihood of the updated parameters is evaluated with an extra
+        pass over validation_data, or over the whole data if it is None, and
+        used instead of the log-likelihood of the (mini-)batch. Recommended
+        with batch_size, where the log-likelihood of a mini-batch is noisy.
+      validation_data: None or held-out data of any of the kinds of data.
+        It is only used with eval_every, which defaults to 1 if it is set.
+      rtol: None or a relative tolerance. If set, the training stops when
+        the relative improvement of the mean log-likelihood falls below
+        rtol, instead of when all the parameter changes fall below TOL.
+      callback: None or a function that is called after every step with
+        the record of the step (see the history property). If it returns
+        True, the realization stops. With n_jobs > 1 it is called in the
+        worker processes and must be picklable.
+      e_step_jobs: Number of worker processes that share the expectation
+        steps over the whole data. The sequences are split into
+        e_step_jobs shards, every worker returns the statistics of a shard
+        and the maximization step runs on their sum. The parameters are
+        sent through shared memory, and data that is not memory-mapped is
+        copied once to every worker. It cannot be combined with n_jobs > 1
+        and the mini-batch steps of batch_size run in this process.
+      stepwise: Whether to run stepwise (online) EM. Every step is then a
+        pass over the data in mini-batches of batch_size sequences (or in
+        the chunks of chunk_size), in a new random order at every pass,
+        except for the batches of a callable, and every
+        mini-batch updates the parameters from running sufficient
+        statistics, into which its statistics per sequence are blended
+        with the weight of the step size. The convergence checks run once
+        per pass, so max_steps and eval_every count passes.
+      step_size: The step size schedule of stepwise, either a function of
+        the number k of earlier updates that returns a weight in (0, 1],
+        or an exponent alpha in (0.5, 1] for the weights (k + 2)^-alpha.
+        Smaller exponents forget the earlier mini-batches faster.
 
     Returns:
-      True if converged, False otherwise.
+      True if the best realization converged, False otherwise. The
+      details of the training are kept in the history property.
 
     """
-    post_max = -1000000000
+    self._ensure_graph()
     tic = time.time()
-    dataset = DataSet(data)
-    KMEANS_NUM = 100
-    kmeans_batch = np.concatenate(dataset.get_batch(
-          min(KMEANS_NUM, dataset.num_examples)), axis=0)
-    if self._hmm_type == 'left-to-right':
-      N = kmeans_batch.shape[-2] // (self._num_states + 1)
-      centers = []
-      sigmas = []
-      for k in range(self._num_states):
-        centers.append(np.mean(kmeans_batch[range(k * N, (k + 1) * N)], axis=-2))
-        sigmas.append(np.mean(kmeans_batch[range(k * N, (k + 1) * N)]**2, axis=-2) - centers[k]**2)
-      # print(sigmas)
-      self._sigma = np.array(
-        [np.identity(self._data_dim, dtype=np.float64)] * self._num_states)
-      for i in range(self._num_states):
-        self._sigma[i] = np.diag(sigmas[i] * (1.0 + 0.3 * np.abs(np.random.randn(len(sigmas[i]),))) )
-    else:
-      kmeans = KMeans(n_clusters=self._num_states)
-    for r in range(num_runs):
-      converged = False
-      if self._hmm_type == 'left-to-right':
-        for i in range(self._num_states):
-          centers[i] = np.multiply(centers[i], 1.0 + 0.05 * (np.random.randn(self._data_dim,)))
-        self._mu = np.array(centers)
+    source = sources.as_source(data, lengths)
+    validation = None
+    if validation_data is not None:
+      validation = sources.as_source(validation_data)
+      eval_every = eval_every or 1
+    n_jobs = min(n_jobs or _num_cpus(), num_runs)
+    if n_jobs > 1 and e_step_jobs > 1:
+      raise ValueError('n_jobs and e_step_jobs cannot be both above one')
+    if stepwise and not callable(step_size) and not 0.5 < step_size <= 1.0:
+      raise ValueError('step_size must be a function or lie in (0.5, 1]')
+    if n_jobs > 1 and seed is None:
+      seed = np.random.randint(2 ** 31 - num_runs)
+    if seed is not None:
+      np.random.seed(seed)
+    init = self._initialization(source, chunk_size)
+    e_step = None
+    if e_step_jobs > 1:
+      e_step = _ShardedEStep(self, e_step_jobs, source, validation, chunk_size)
+    init_time = time.time() - tic
+    fit_args = (source, init, max_steps, batch_size, TOL, min_var, chunk_size,
+                eval_every, validation, rtol, callback, e_step, stepwise,
+                step_size)
+    seeds = [None if seed is None else seed + r for r in range(num_runs)]
+    try:
+      if n_jobs == 1:
+        runs = [self._fit_run(r, seeds[r], *fit_args) for r in range(num_runs)]
       else:
-        kmeans = KMeans(
-          n_clusters=self._num_states, random_state=r).fit(kmeans_batch)
-        self._mu = kmeans.cluster_centers_
-      self._p0, self._tp = self._init_p0_tp()
-      if self._hmm_type != 'left-to-right':
-        self._sigma = np.array(
-          [np.identity(self._data_dim, dtype=np.float64)] * self._num_states)
-      with tf.Session(graph=self._graph) as sess:
-        sess.run(tf.global_variables_initializer())
-        for step in range(max_steps):
-          if batch_size is None:
-            feed_dict = {
-              self._dataset_tf: dataset.data, self._p0_tf: self._p0,
-              self._tp_tf: self._tp, self._mu_tf: self._mu,
-              self._sigma_tf: self._sigma, self._min_var_tf: min_var}
-          else:
-            batch = dataset.get_batch(batch_size)
-            feed_dict = {
-              self._dataset_tf: batch, self._p0_tf: self._p0,
-              self._tp_tf: self._tp, self._mu_tf: self._mu,
-              self._sigma_tf: self._sigma, self._min_var_tf: min_var}
-          if step == 0:
-            p0_prev = np.zeros((self._num_states,))
-            tp_prev = np.zeros((self._num_states, self._num_states))
-            mu_prev = np.zeros((self._num_states, self._data_dim,))
-            sigma_prev = np.zeros((
-              self._num_states, self._data_dim, self._data_dim))
-          else:
-            p0_prev = self._p0
-            tp_prev = self._tp
-            mu_prev = self._mu
-            sigma_prev = self._sigma
-          self._p0, self._tp, self._mu, self._sigma = sess.run(
-            [self._p0_tf_new, self._tp_tf_new,
-             self._mu_tf_new, self._sigma_tf_new],
-            feed_dict=feed_dict)
-          # check if the sigma is positive definite
-          for k in range(self._num_states):
-            j = 0
-            while not self._is_pos_def(self._sigma[k]):
-              j += 1
-              # print('.. not positive definite ..')
-              self._sigma[k] = self._sigma[k] + 0.05 * np.array(
-                [np.identity(self._data_dim, dtype=np.float64)])*self._sigma[k]
-          post = np.mean(
-            np.squeeze(sess.run(
-              self._posterior, feed_dict={
-                self._dataset_tf: dataset.data, self._p0_tf: self._p0,
-                self._tp_tf: self._tp, self._mu_tf: self._mu,
-                self._sigma_tf: self._sigma})))
-          if post > post_max:
-            p0_max = self._p0
-            tp_max = self._tp
-            mu_max = self._mu
-            sigma_max = self._sigma
-          ch_p0 = np.max(np.abs(self._p0 - p0_prev))
-          ch_tp = np.max(np.abs(self._tp - tp_prev))
-          ch_mu = np.max(np.abs(self._mu - mu_prev))
-          ch_sigma = np.max(np.abs(self._sigma - sigma_prev))
-          # print('step = ', step, ' ', post)
-          if ch_p0 < TOL and ch_tp < TOL and ch_mu < TOL and ch_sigma < TOL:
-            converged = True
-            break
-        # print('steps = ', step, ' ', post)
-    self._p0 = p0_max
-    self._tp = tp_max
-    self._mu = mu_max
-    self._sigma = sigma_max
+        runs = self._parallel_fit_runs(n_jobs, seeds, fit_args)
+    finally:
+      if e_step is not None:
+        e_step.close()
+    # keep the realization with the highest log-scale posterior
+    best_run = max(range(num_runs), key=lambda r: runs[r]['post'])
+    best = runs[best_run]
+    self._p0, self._tp, self._mu, self._sigma = best['params']
     self._epoch += 1
+    self._params_version += 1
     toc = time.time()
-    # print('training time : ', toc-tic, ' seconds.')
-    return converged
+    self._history = {
+      'runs': [run['history'] for run in runs],
+      'best_run': best_run,
+      'time': {'initialization': init_time, 'total': toc - tic},
+      'peak_rss_mb': _peak_rss_mb()}
+    return best['converged']
 
-  def run_viterbi(self, data):
+  def run_viterbi(self, data, lengths=None, return_log_prob=False):
     """Implements the viterbi decoding algorithm.
 
     Args:
-      data: A numpy array of rank two or three represents the observed data.
+      data: A numpy array of rank two or three represents the observed data,
+        a list of rank two arrays of variable lengths, or a rank two array
+        of concatenated sequences.
+      lengths: None or the lengths of the concatenated sequences in data.
+      return_log_prob: If True, the log-probabilities of the paths are
+        returned as well.
 
     Returns:
-      A numpy array contains he most probable hidden state paths.
+      A numpy array contains he most probable hidden state paths, or a list
+      of paths for variable-length sequences. If return_log_prob is True,
+      a tuple of the paths and a numpy array of their log-probabilities.
     """
-    dataset = DataSet(data)
-    tic = time.time()
-    with tf.Session(graph=self._graph) as sess:
-      sess.run(tf.global_variables_initializer())
-      feed_dict = feed_dict = {
-        self._dataset_tf: dataset.data, self._p0_tf: self._p0,
-        self._tp_tf: self._tp, self._mu_tf: self._mu,
-        self._sigma_tf: self._sigma}
-      toc = time.time()
-      # print('inference time : ', toc-tic, ' seconds.')
-      w, am = sess.run([self._w, self._am], feed_dict=feed_dict)
-      w = (w[:, -1, :])
-      argmax_w = np.argmax(w, axis=1)
-      psi = np.concatenate((am[range(len(w)), 1::, argmax_w], np.expand_dims(argmax_w, 1)), -1)
-      dec = []
-      for i, p in enumerate(am):
-        dec_p = [argmax_w[i]]
-        c = p[::-1, :]
-        l = argmax_w[i]
-        for j in range(len(c) - 1):
-          # print(c[j][l])
-          dec_p.insert(0, c[j][l])
-          l = c[j][l]
-        dec_p.insert(0, l)
-        dec.append(dec_p)
-      return np.squeeze(np.array(dec, dtype='int16'))
-
-  def generate(self, num_samples):
+    if lengths is None and not isinstance(data, (list, tuple)):
+      dataset = DataSet(data)
+      dec, log_prob = self._backtrace(*self._viterbi_batch(dataset.data, None))
+      dec, log_prob = np.squeeze(dec), np.squeeze(log_prob)
+    else:
+      sequences = sources.split_sequences(data, lengths)
+      dec = [None] * len(sequences)
+      log_prob = np.empty((len(sequences),))
+      for idx, batch, mask in sources.buckets(sequences):
+        paths, log_prob[idx] = self._backtrace(
+          *self._viterbi_batch(batch, mask))
+        for i, j in enumerate(idx):
+          # the padded frames repeat the last state of the path
+          dec[j] = paths[i, :sequences[j].shape[0]]
+    if return_log_prob:
+      return dec, log_prob
+    return dec
+
+  def predict_proba(self, data, lengths=None, return_transitions=False,
+                    out=None, chunk_size=None):
+    """Calculates the posterior probabilities of the states of every frame
+       with the forward-backward algorithm.
+
+    The sequences are processed chunk by chunk and the probabilities of
+    every chunk are written into the output array, which may be a
+    memory-mapped array, so that no array of all the frames of the data is
+    ever built in memory besides the output.
+
+    Args:
+      data: A numpy array with rank two or three (possibly a np.memmap),
+        a list of rank two arrays of variable lengths, or a rank two array
+        of concatenated sequences.
+      lengths: None or the lengths of the concatenated sequences in data.
+      return_transitions: If True, the expected numbers of transitions
+        between the states of every sequence are returned as well.
+      out: None, a numpy array of the shape of the probabilities (possibly
+        a np.memmap), or the path of a .npy file that is created as a
+        memory-mapped array.
+      chunk_size: None or the maximum number of sequences per chunk, 64
+        by default.
+
+    Returns:
+      The state probabilities, a numpy array of shape (I, N, states) for
+      rank three data, (N, states) for rank two data, and (frames, states),
+      in the order of the concatenated frames, for variable-length
+      sequences. If return_transitions is True, a tuple of the probabilities
+      and the expected transition counts, shape (I, states, states), or
+      (states, states) for rank two data.
+    """
+    size = chunk_size or sources.BUCKET_SIZE
+    if lengths is None and not isinstance(data, (list, tuple)):
+      single = np.ndim(data) == 2
+      shape = np.shape(data)[:-1] + (self._num_states,)
+      out = self._output_array(out, shape)
+      gamma = out[np.newaxis] if single else out
+      xi = np.empty((gamma.shape[0], self._num_states, self._num_states))
+      start = 0
+      for batch, _ in sources.ArraySource(data).chunks(size):
+        end = start + batch.shape[0]
+        gamma[start:end], xi[start:end] = self._smooth_batch(batch, None)
+        start = end
+    else:
+      single = False
+      sequences = sources.split_sequences(data, lengths)
+      offsets = np.cumsum([0] + [x.shape[0] for x in sequences])
+      out = self._output_array(out, (offsets[-1], self._num_states))
+      xi = np.empty((len(sequences), self._num_states, self._num_states))
+      for idx, batch, mask in sources.buckets(sequences, size):
+        gamma, xi[idx] = self._smooth_batch(batch, mask)
+        for i, j in enumerate(idx):
+          out[offsets[j]:offsets[j + 1]] = gamma[i, :sequences[j].shape[0]]
+    if isinstance(out, np.memmap):
+      out.flush()
+    if single:
+      xi = xi[0]
+    if return_transitions:
+      return out, xi
+    return out
+
+  def generate(self, num_samples, num_sequences=None, seed=None):
     """Generate simulated data from the model.
 
+    The Markov chains of all the sequences run in parallel and the
+    emissions are drawn only for the visited states, in NumPy for both
+    backends.
+
+    Args:
+      num_samples: The number of samples of each generated sequence.
+      num_sequences: None for a single sequence, or the number of sequences.
+      seed: None or a random seed, for reproducible sequences.
+
+    Returns:
+      The numpy array of the generated sequence of observations, shape
+      (num_samples, dim), and of its hidden states, shape (num_samples, 1),
+      or of shapes (num_sequences, num_samples, dim) and
+      (num_sequences, num_samples) if num_sequences is given.
+    """
+    random_state = None if seed is None else np.random.RandomState(seed)
+    return numpy_backend.sample(
+      num_samples, self._p0, self._tp, self._mu, self._sigma,
+      random_state=random_state, covariance_type=self._covariance_type,
+      num_sequences=num_sequences, factors=self._gaussian_factors())
+
+  def online_filter(self, num_streams=1, lag=0, viterbi_window=None):
+    """Creates an online forward filter for live streams of observations.
+
     Args:
-      num_samples: The number of samples of the generated data.
+      num_streams: Number of streams that are filtered in parallel.
+      lag: The lag of the fixed-lag smoothed estimates, 0 disables them.
+      viterbi_window: None or the length of the traceback window of the
+        online viterbi decoder.
+
+    Returns:
+      An OnlineFilter with a copy of the current model parameters.
+    """
+    return OnlineFilter(self._p0, self._tp, self._mu, self._sigma,
+                        num_streams=num_streams, lag=lag,
+                        viterbi_window=viterbi_window,
+                        covariance_type=self._covariance_type,
+                        factors=self._gaussian_factors())
+
+  def serve(self):
+    """Enables the serving mode of the model.
+
+    A single session is kept open and the model parameters stay resident
+    in graph variables between calls of posterior and run_viterbi.
+    The parameters are uploaded again only after fit or load_model have
+    changed them. The session is released by close, or when the model is
+    used as a context manager, e.g. `with model.serve(): ...`.
 
     Returns:
-      The numpy array of the generated sequence of observations.
+      The model itself.
     """
-    with tf.Session(graph=self._graph) as sess:
-      sess.run(tf.global_variables_initializer())
-      feed_dict = {
-        self._p0_tf: self._p0,
-        self._tp_tf: self._tp, self._mu_tf: self._mu,
-        self._sigma_tf: self._sigma, self._num_samples_tf: num_samples}
-      states, samples = sess.run(
-        [self._states, self._samples], feed_dict=feed_dict)
-      return samples, states
+    if self._backend == 'numpy':
+      return self
+    if self._session is None:
+      self._ensure_graph()
+      self._session = tf.Session(
+        graph=self._graph, config=self._session_config)
+      self._session.run(self._init_op)
+      self._uploaded_version = -1
+    return self
+
+  def close(self):
+    """Closes the serving session, if any."""
+    if getattr(self, '_session', None) is not None:
+      self._session.close()
+      self._session = None
   
   def save_model(self, filename):
-    """Saves the model parameters to a numpy file
-    
+    """Saves the model to a single file, see the store module.
+
+    The file holds the configuration of the model, its training epoch, its
+    parameters and the factors of its covariances, and can be loaded by
+    load_model or memory-mapped by HMM.load.
+
     Args:
-      filename: The path to a numppy .npz file where the model parameters will be saved.
+      filename: The path to the file where the model will be saved.
     """
     if self._epoch > 0:
-      np.savez(filename, p0 = self._p0, tp = self._tp, mu = self._mu, sigma = self._sigma)
+      scale, inv_scale, log_det = self._gaussian_factors()
+      config = {'num_states': self._num_states, 'data_dim': self._data_dim,
+                'hmm_type': self._hmm_type,
+                'covariance_type': self._covariance_type,
+                'recursion': self._recursion, 'dtype': self._dtype,
+                'epoch': self._epoch}
+      store.write_model(filename, config, collections.OrderedDict([
+        ('p0', self._p0), ('tp', self._tp), ('mu', self._mu),
+        ('sigma', self._sigma), ('scale', scale), ('inv_scale', inv_scale),
+        ('log_det', log_det)]))
     else:
       print('Nothing to do. The model must have been trained first in order to run this method')
 
   def load_model(self, filename):
-    """Loads the model parameters from a numpy file
-    
+    """Loads the model parameters from a file of save_model.
+
+    The parameters of a trained model are replaced, and a serving session
+    uploads the new parameters on its next call.
+
     Args:
-      filename: The path to a numpy .npz file where the model parameters have been stored.
+      filename: The path to a file of save_model, or to a numpy .npz file
+        of the earlier versions of save_model.
     """
-    if self._epoch == 0:
-      z = np.load(filename)
-      self._p0 = z['p0']
-      self._tp = z['tp']
-      self._mu = z['mu']
-      self._sigma = z['sigma']
-      self._epoch = 1
+    if store.is_model_file(filename):
+      config, arrays = store.read_model(filename, mmap=False)
     else:
-      print('ERROR: The model parameters did not load properly')
+      z = np.load(filename)
+      # models saved before the covariance types have full covariances
+      config = {'num_states': self._num_states, 'data_dim': self._data_dim,
+                'hmm_type': self._hmm_type,
+                'covariance_type': str(z['covariance_type'])
+                if 'covariance_type' in z else 'full', 'epoch': 1}
+      arrays = {name: z[name] for name in ('p0', 'tp', 'mu', 'sigma')}
+    for key, value in (('num_states', self._num_states),
+                       ('data_dim', self._data_dim),
+                       ('hmm_type', self._hmm_type),
+                       ('covariance_type', self._covariance_type)):
+      if config[key] != value:
+        raise ValueError('the model was saved with ' + key + ' ' +
+                         str(config[key]) + ', not ' + str(value))
+    self._set_params(config, arrays)
+
+  @classmethod
+  def load(cls, filename, backend='numpy', mmap=True, cache=True):
+    """Creates a model from a file of save_model.
+
+    The configuration comes from the file, so no model has to be built
+    first, and with the numpy backend no graph is built at all. The
+    parameters and the factors of the covariances are read-only views of a
+    memory map of the file, shared by all the processes that load it.
+
+    Args:
+      filename: The path to a file of save_model.
+      backend: The inference backend (tensorflow, numpy).
+      mmap: Whether the parameters are memory-mapped, or read into memory.
+      cache: True for the process-level store.MODEL_CACHE, a
+        store.ModelCache, or False. A cached model is shared by all the
+        callers, and is loaded again only after its file changes.
+
+    Returns:
+      The HMM instance.
+    """
+    if cache is False or cache is None:
+      return cls._from_file(filename, backend, mmap)[0]
+    if cache is True:
+      cache = store.MODEL_CACHE
+    return cache.get(filename, cls._from_file, backend, mmap)
 
   @property
   def p0(self):
@@ -310,250 +723,917 @@ class HMM(object):
 
   @property
   def sigma(self):
-    return self._sigma
+    """The covariance matrices of the states, shape (states, dim, dim)."""
+    return numpy_backend.full_covariances(
+      self._sigma, self._covariance_type, self._num_states, self._data_dim)
+
+  @property
+  def covariance_type(self):
+    return self._covariance_type
+
+  @property
+  def history(self):
+    """The training history of the last call of fit, None before.
+
+    A dict with the history of every realization in 'runs', the index of
+    the kept realization in 'best_run', the wall times of the shared
+    initialization and of the whole fit in 'time' and the memory
+    high-water mark in MB in 'peak_rss_mb'. The history of a realization
+    has its 'seed', the records of its 'steps', whether it 'converged' or
+    was 'stopped' by the callback, its best 'log_likelihood' and its
+    'time' of 'initialization' and in 'total'. The record of a step has
+    the 'run', the 'step', the mean 'log_likelihood' of the expectation
+    step, the 'eval_log_likelihood' of the updated parameters if they
+    were evaluated (see eval_every), the max-abs parameter changes in
+    'deltas', the number of positive-definiteness 'repairs', the number
+    of parameter 'updates', the last 'step_size' of stepwise EM (None
+    otherwise), the wall time of the 'e_step', 'm_step', 'repair',
+    'evaluation' and in 'total' in 'time', and the 'peak_rss_mb'.
+    """
+    return self._history
+
+  def _ensure_graph(self):
+    # builds the computational graph on first use
+    if self._graph is None:
+      _import_tensorflow()
+      self._dir = tempfile.mkdtemp()
+      self._graph = tf.Graph()
+      self._emission_parameters()
+      self._create_the_computational_graph()
 
   def _create_the_computational_graph(self):
     with self._graph.as_default():
       self._dataset_tf = tf.placeholder(
-        'float64', shape=[None, None, self._data_dim])
-      self._num_samples_tf = tf.placeholder('int32')
-      self._min_var_tf = tf.placeholder('float64')
-      self._p0_tf = tf.placeholder(tf.float64, shape=[1, self._num_states])
-      self._tp_tf = tf.placeholder(
-        tf.float64, shape=[self._num_states, self._num_states])
+        self._dtype, shape=[None, None, self._data_dim])
+      # mask shape : (I, N), ones on the frames and zeros on the padding
+      self._mask_tf = tf.placeholder_with_default(
+        tf.ones(tf.shape(self._dataset_tf)[:2], dtype=self._dtype),
+        shape=[None, None])
+      # True runs the associative scans instead of the recursions
+      self._scan_tf = tf.placeholder_with_default(False, shape=[])
+      self._p0_tf = self._parameter_input('p0', [1, self._num_states])
+      self._tp_tf = self._parameter_input(
+        'tp', [self._num_states, self._num_states])
+      if self._banded:
+        self._transition_band()
       self._emissions_eval()
       self._forward()
       self._backward()
       self._expectation()
-      self._maximization()
-      self._simulate()
+      self._sufficient_statistics()
       self._viterbi()
       self._saver = tf.train.Saver()
+      self._init_op = tf.global_variables_initializer()
 
-  def _emission_probs_family(self):
+  def _emission_parameters(self):
+    # The covariances enter the graph through their inverse scale factors
+    # and log-determinants, which are computed once per parameter version
+    # (see _gaussian_factors) instead of at every run of the graph.
+    _, inv_scale, log_det = self._gaussian_factors()
     with self._graph.as_default():
-      self._mu_tf = tf.placeholder(
-          tf.float64, shape=[self._num_states, self._data_dim])
-      self._sigma_tf = tf.placeholder(
-          tf.float64, shape=[self._num_states, self._data_dim, self._data_dim])
-      return MultivariateNormalFullCovariance(loc=self._mu_tf,
-                                              covariance_matrix=self._sigma_tf)
+      self._mu_tf = self._parameter_input(
+        'mu', [self._num_states, self._data_dim])
+      self._inv_scale_tf = self._parameter_input(
+        'inv_scale', list(inv_scale.shape))
+      self._log_det_tf = self._parameter_input('log_det', list(log_det.shape))
+
+  def _parameter_input(self, name, shape):
+    # The parameter is fed directly during training. In serving mode it
+    # defaults to a resident variable, updated through an assign op.
+    with tf.variable_scope('parameters'):
+      var = tf.Variable(tf.zeros(shape, dtype=self._dtype), name=name,
+                        trainable=False)
+      value = tf.placeholder(self._dtype, shape=shape, name=name + '_value')
+      self._upload_ops.append(tf.assign(var, value))
+      self._upload_feeds.append((value, name))
+      return tf.placeholder_with_default(var, shape=shape, name=name + '_tf')
+
+  def _params_values(self):
+    # the values of the parameter inputs of the graph
+    _, inv_scale, log_det = self._gaussian_factors()
+    return {'p0': self._p0, 'tp': self._tp, 'mu': self._mu,
+            'inv_scale': inv_scale, 'log_det': log_det}
+
+  def _params_feed(self):
+    values = self._params_values()
+    return {self._p0_tf: values['p0'], self._tp_tf: values['tp'],
+            self._mu_tf: values['mu'], self._inv_scale_tf: values['inv_scale'],
+            self._log_det_tf: values['log_det']}
+
+  def _run(self, fetches, feed_dict):
+    # runs the inference fetches, either in a temporary session or in the
+    # serving session, where the parameters are uploaded only if changed
+    self._ensure_graph()
+    if self._session is None:
+      feed_dict.update(self._params_feed())
+      with tf.Session(graph=self._graph, config=self._session_config) as sess:
+        sess.run(self._init_op)
+        return sess.run(fetches, feed_dict=feed_dict)
+    if self._uploaded_version != self._params_version:
+      values = self._params_values()
+      self._session.run(self._upload_ops, feed_dict={
+        value: values[name] for value, name in self._upload_feeds})
+      self._uploaded_version = self._params_version
+    return self._session.run(fetches, feed_dict=feed_dict)
 
   def _emissions_eval(self):
     with tf.variable_scope('emissions_eval'):
-      dataset_expanded = tf.expand_dims(self._dataset_tf, -2)
-      self._emissions = self._em_probs.prob(dataset_expanded)
+      x = self._dataset_tf
+      mu = self._mu_tf
+      if self._covariance_type in ('diag', 'spherical'):
+        # the quadratic forms of all the states are two products over the
+        # frames, O(dim) per frame and state
+        prec = tf.square(self._inv_scale_tf) * tf.ones(
+          [1, self._data_dim], dtype=self._dtype)
+        quad = (tf.tensordot(tf.square(x), prec, [[2], [1]]) -
+                2.0 * tf.tensordot(x, mu * prec, [[2], [1]]) +
+                tf.reduce_sum(tf.square(mu) * prec, -1))
+      else:
+        # the tied factor is shared by all the states
+        inv_scale = self._inv_scale_tf * tf.ones(
+          [self._num_states, 1, 1], dtype=self._dtype)
+        # z shape : (I, N, K, D), the whitened frames of every state
+        z = (tf.tensordot(x, inv_scale, [[2], [2]]) -
+             tf.reduce_sum(inv_scale * tf.expand_dims(mu, 1), -1))
+        quad = tf.reduce_sum(tf.square(z), -1)
+      # the padded frames are emitted with probability one
+      mask = tf.expand_dims(self._mask_tf, -1)
+      self._log_emissions = mask * -0.5 * (
+        quad + self._log_det_tf + self._data_dim * np.log(2.0 * np.pi))
+      # The emissions are shifted by their maximum over the states, so that
+      # they never all underflow. The shifts cancel out in alpha, betta,
+      # gamma and xi and are added back to the log-likelihood.
+      self._log_shift = tf.reduce_max(
+        self._log_emissions, axis=-1, keepdims=True)
+      self._emissions = tf.exp(self._log_emissions - self._log_shift)
+
+  def _transition_band(self):
+    # tp[k, k] and tp[k, (k + 1) % states], the only non-zero transitions
+    # of the left-to-right and cyclic models, shape (states,)
+    states = np.arange(self._num_states)
+    next_states = np.stack([states, (states + 1) % self._num_states], -1)
+    self._tp_stay = tf.matrix_diag_part(self._tp_tf)
+    self._tp_move = tf.gather_nd(self._tp_tf, next_states)
 
-  def _forward_step(self, n, alpha, c):
+  def _transition(self, x, transpose=False):
+    # x tp, or x tp^T, for x of shape (I, states)
+    if not self._banded:
+      return tf.matmul(x, self._tp_tf, transpose_b=transpose)
+    if transpose:
+      return x * self._tp_stay + self._tp_move * self._roll_states(x, -1)
+    return x * self._tp_stay + self._roll_states(x * self._tp_move, 1)
+
+  def _roll_states(self, x, shift):
+    # np.roll(x, shift, axis=-1) for a shift of 1 or -1
+    return tf.concat([x[..., -shift:], x[..., :-shift]], axis=-1)
+
+  def _forward_step(self, n, alpha_prev, alpha, c):
     # calculate alpha[n-1] tp
-    alpha_tp = tf.matmul(alpha[n - 1], self._tp_tf)
+    alpha_tp = self._transition(alpha_prev)
     # calculate p(x|z) \sum_z alpha[n-1] tp
-    a_n_tmp = tf.multiply(tf.squeeze(self._emissions[:, n, :]), alpha_tp)
+    a_n_tmp = tf.multiply(self._emissions[:, n, :], alpha_tp)
     c_n_tmp = tf.expand_dims(tf.reduce_sum(a_n_tmp, axis=-1), -1)
-    return [n + 1, tf.concat([alpha, tf.expand_dims(a_n_tmp / c_n_tmp, 0)], 0),
-            tf.concat([c, tf.expand_dims(c_n_tmp, 0)], 0)]
-
-  def _backward_step(self, n, betta, b_p):
-    b_p_tmp = tf.multiply(betta[0],
-                          tf.squeeze(self._emissions[:, -n, :]))
-    b_n_tmp = tf.matmul(b_p_tmp, self._tp_tf, transpose_b=True) / self._c[-n]
-    return [n + 1, tf.concat([tf.expand_dims(b_n_tmp, 0), betta], 0),
-            tf.concat([tf.expand_dims(b_p_tmp, 0), b_p], 0)]
-
-  def _simulate_step(self, n, states, samples):
-    state = tf.expand_dims(
-      tf.where(
-        tf.squeeze(
-          self._cum_tp_tf[
-            tf.cast(states[n - 1, 0], dtype='int32')] > self._rand[n]))[0], 0)
-    sample = tf.expand_dims(self._em_probs.sample()[tf.cast(
-      state[0, 0], dtype='int32')], 0)
-    return [n + 1, tf.concat(
-      [states, state], 0), tf.concat([samples, sample], 0)]
+    # alpha stays unchanged and c is one on the padded frames
+    valid = self._mask_tf[:, n] > 0
+    alpha_n = tf.where(valid, a_n_tmp / c_n_tmp, alpha_prev)
+    c_n_tmp = tf.where(valid, c_n_tmp, tf.ones_like(c_n_tmp))
+    return [n + 1, alpha_n, alpha.write(n, alpha_n), c.write(n, c_n_tmp)]
+
+  def _backward_step(self, n, betta_next, betta, b_p):
+    # betta and b_p are written backwards in time, starting from N - 2
+    t = tf.shape(self._dataset_tf)[1] - 1 - n
+    b_p_tmp = tf.multiply(betta_next, self._emissions[:, t + 1, :])
+    b_n_tmp = self._transition(b_p_tmp, transpose=True) / self._c[t + 1]
+    # betta is one before the padded frames
+    b_n_tmp = tf.where(
+      self._mask_tf[:, t + 1] > 0, b_n_tmp, tf.ones_like(b_n_tmp))
+    return [n + 1, b_n_tmp, betta.write(t, b_n_tmp), b_p.write(t, b_p_tmp)]
 
   def _forward(self):
     with tf.variable_scope('forward'):
-      n = tf.shape(self._dataset_tf)[1]
       # alpha shape : (N, I, states)
       # c shape : (N, I, 1)
-      a_0_tmp = tf.expand_dims(
-        tf.multiply(self._emissions[:, 0, :], tf.squeeze(self._p0_tf)), 0)
-      c_0 = tf.expand_dims(tf.reduce_sum(a_0_tmp, axis=-1), -1)
-      alpha_0 = a_0_tmp / c_0
-      i0 = tf.constant(1)
-      condition_forward = lambda i, alpha, c: tf.less(i, n)
-      _, self._alpha, self._c = \
-          tf.while_loop(
-            condition_forward,
-            self._forward_step,
-            [i0, alpha_0, c_0],
-            shape_invariants=[
-              i0.get_shape(),
-              tf.TensorShape(
-                [None, None, self._num_states]),
-              tf.TensorShape([None, None, 1])])
-      self._posterior = tf.reduce_sum(tf.log(self._c), axis=0)
+      self._alpha, self._c = tf.cond(
+        self._scan_tf, self._forward_scan, self._forward_recursion)
+      # the log-likelihoods are summed in float64 : shape (I, 1)
+      self._posterior = (
+        tf.reduce_sum(tf.cast(tf.log(self._c), tf.float64), axis=0) +
+        tf.reduce_sum(tf.cast(self._log_shift, tf.float64), axis=1))
+
+  def _forward_recursion(self):
+    n = tf.shape(self._dataset_tf)[1]
+    a_0_tmp = tf.multiply(self._emissions[:, 0, :], tf.squeeze(self._p0_tf))
+    c_0 = tf.expand_dims(tf.reduce_sum(a_0_tmp, axis=-1), -1)
+    alpha_0 = a_0_tmp / c_0
+    # alpha and c are written once per time step into preallocated arrays
+    alpha_ta = tf.TensorArray(
+      self._dtype, size=n,
+      element_shape=tf.TensorShape([None, self._num_states])).write(0, alpha_0)
+    c_ta = tf.TensorArray(
+      self._dtype, size=n, element_shape=tf.TensorShape([None, 1])).write(0, c_0)
+    i0 = tf.constant(1)
+    condition_forward = lambda i, alpha_prev, alpha, c: tf.less(i, n)
+    _, _, alpha_ta, c_ta = \
+        tf.while_loop(
+          condition_forward,
+          self._forward_step,
+          [i0, alpha_0, alpha_ta, c_ta],
+          shape_invariants=[
+            i0.get_shape(),
+            tf.TensorShape([None, self._num_states]),
+            tf.TensorShape(None),
+            tf.TensorShape(None)])
+    return alpha_ta.stack(), c_ta.stack()
+
+  def _forward_scan(self):
+    # alpha[n] is the normalized first row of the product of the operators
+    # of the frames 0, ..., n, see numpy_backend.forward_operators, and
+    # c[n] the ratio of the normalizations of the products n and n - 1
+    prod, log_scale = self._scan_products(self._transition_operators())
+    row = prod[:, :, 0]
+    row_sum = tf.reduce_sum(row, axis=-1, keepdims=True)
+    log_z = tf.expand_dims(log_scale, -1) + tf.log(row_sum)
+    c = tf.exp(tf.concat([log_z[:1], log_z[1:] - log_z[:-1]], axis=0))
+    # c is one on the padded frames
+    mask = tf.expand_dims(tf.transpose(self._mask_tf), -1)
+    return row / row_sum, mask * c + (1.0 - mask)
+
+  def _transition_operators(self):
+    # ops[0] has p0 p(x[0]|z) on every row, ops[n] = tp diag(p(x[n]|z)),
+    # and the identity on the padded frames : shape (N, I, states, states)
+    em = tf.transpose(self._emissions, perm=[1, 0, 2])
+    ops = tf.expand_dims(em, -2) * self._tp_tf
+    op_0 = tf.expand_dims(em[0] * self._p0_tf, -2) * tf.ones(
+      [self._num_states, 1], dtype=self._dtype)
+    ops = tf.concat([tf.expand_dims(op_0, 0), ops[1:]], axis=0)
+    mask = tf.reshape(tf.transpose(self._mask_tf), [
+      tf.shape(ops)[0], tf.shape(ops)[1], 1, 1])
+    return mask * ops + (1.0 - mask) * tf.eye(
+      self._num_states, dtype=self._dtype)
+
+  def _scan_products(self, ops, reverse=False, combine=None):
+    # The inclusive prefix products of ops, shape (N, I, states, states),
+    # or the suffix products ops[n] ... ops[N - 1] with reverse, in
+    # O(log N) steps of batched products (Hillis-Steele scan). With the
+    # default matrix product, every product is normalized by its sum and
+    # the logarithms of the sums are returned apart, shape (N, I).
+    if reverse:
+      ops = tf.reverse(ops, [0])
+    n = tf.shape(ops)[0]
+    normalized = combine is None
+    if normalized:
+      combine = tf.matmul
+      scale = tf.reduce_sum(ops, axis=[-2, -1])
+      ops = ops / tf.expand_dims(tf.expand_dims(scale, -1), -1)
+      log_scale = tf.log(scale)
+    else:
+      log_scale = tf.zeros(tf.shape(ops)[:2], dtype=ops.dtype)
+
+    def scan_step(shift, prod, log_scale):
+      if reverse:
+        new = combine(prod[shift:], prod[:-shift])
+      else:
+        new = combine(prod[:-shift], prod[shift:])
+      new_log_scale = log_scale[:-shift] + log_scale[shift:]
+      if normalized:
+        scale = tf.reduce_sum(new, axis=[-2, -1])
+        new = new / tf.expand_dims(tf.expand_dims(scale, -1), -1)
+        new_log_scale += tf.log(scale)
+      return [shift * 2, tf.concat([prod[:shift], new], axis=0),
+              tf.concat([log_scale[:shift], new_log_scale], axis=0)]
+    shift0 = tf.constant(1)
+    _, prod, log_scale = tf.while_loop(
+      lambda shift, prod, log_scale: tf.less(shift, n), scan_step,
+      [shift0, ops, log_scale],
+      shape_invariants=[
+        shift0.get_shape(),
+        tf.TensorShape([None, None, self._num_states, self._num_states]),
+        tf.TensorShape([None, None])])
+    if reverse:
+      return tf.reverse(prod, [0]), tf.reverse(log_scale, [0])
+    return prod, log_scale
+
+  def _max_plus(self, a, b):
+    # the matrix product in the max-plus semiring, max_j a[i, j] + b[j, k]
+    out = a[..., :, 0:1] + b[..., 0:1, :]
+    for j in range(1, self._num_states):
+      out = tf.maximum(out, a[..., :, j:j + 1] + b[..., j:j + 1, :])
+    return out
 
   def _backward(self):
     with tf.variable_scope('backward'):
-      n = tf.shape(self._dataset_tf)[1]
-      shape = tf.shape(self._dataset_tf)[0]
-      dims = tf.stack([shape, self._num_states])
-      b_tmp_ = tf.fill(dims, 1.0)
-      betta_0 = tf.expand_dims(tf.ones_like(b_tmp_, dtype=tf.float64), 0)
-      b_p_0 = tf.expand_dims(tf.ones_like(b_tmp_, dtype=tf.float64), 0)
-      i0 = tf.constant(1)
-      condition_backward = lambda i, betta, b_p: tf.less(i, n)
-      _, self._betta, b_p_tmp = \
-          tf.while_loop(
-            condition_backward,
-            self._backward_step,
-            [i0, betta_0, b_p_0],
-            shape_invariants=[
-              i0.get_shape(),
-              tf.TensorShape([None, None, self._num_states]),
-              tf.TensorShape([None, None, self._num_states])])
-      self._b_p = b_p_tmp[:-1, :, :]
-
-  def _simulate(self):
-    with self._graph.as_default():
-      self._rand = tf.random_uniform(
-        [self._num_samples_tf, 1], maxval=1.0, dtype='float64')
-      self._cum_p0_tf = tf.cumsum(self._p0_tf, axis=1)
-      self._cum_tp_tf = tf.cumsum(self._tp_tf, axis=1)
-      # initial sample
-      _init_sample_state = tf.expand_dims(
-        tf.where(tf.squeeze(self._cum_p0_tf > self._rand[0]))[0], 0)
-      _init_sample = tf.expand_dims(self._em_probs.sample()[tf.cast(
-        _init_sample_state[0, 0], dtype='int32')], 0)
-      i0 = tf.constant(1, dtype='int32')
-      condition_sim = lambda i, states, samples: tf.less(
-        i, self._num_samples_tf)
-      _, self._states, self._samples = tf.while_loop(
-        condition_sim, self._simulate_step,
-        [i0, _init_sample_state, _init_sample],
-        shape_invariants=[
-          i0.get_shape(), tf.TensorShape(
-            [None, 1]), tf.TensorShape([None, self._data_dim])])
-
-  def _xi_calc(self, n, xi):
-    a_b_p = tf.matmul(
-      tf.expand_dims(self._alpha[n - 1] / self._c[n], -1),
-      tf.expand_dims(self._b_p[n - 1], -1), transpose_b=True)
-    xi_n_tmp = tf.multiply(a_b_p, self._tp_tf)
-    return [n + 1, tf.concat([xi, tf.expand_dims(xi_n_tmp, 0)], 0)]
+      self._betta, self._b_p = tf.cond(
+        self._scan_tf, self._backward_scan, self._backward_recursion)
+
+  def _backward_recursion(self):
+    n = tf.shape(self._dataset_tf)[1]
+    shape = tf.shape(self._dataset_tf)[0]
+    dims = tf.stack([shape, self._num_states])
+    betta_0 = tf.ones(dims, dtype=self._dtype)
+    betta_ta = tf.TensorArray(
+      self._dtype, size=n,
+      element_shape=tf.TensorShape([None, self._num_states])).write(
+        n - 1, betta_0)
+    # b_p[n] = betta[n + 1] p(x[n + 1]|z), defined for n = 0, ..., N - 2
+    b_p_ta = tf.TensorArray(
+      self._dtype, size=n - 1,
+      element_shape=tf.TensorShape([None, self._num_states]))
+    i0 = tf.constant(1)
+    condition_backward = lambda i, betta_next, betta, b_p: tf.less(i, n)
+    _, _, betta_ta, b_p_ta = \
+        tf.while_loop(
+          condition_backward,
+          self._backward_step,
+          [i0, betta_0, betta_ta, b_p_ta],
+          shape_invariants=[
+            i0.get_shape(),
+            tf.TensorShape([None, self._num_states]),
+            tf.TensorShape(None),
+            tf.TensorShape(None)])
+    b_p = tf.cond(
+      n > 1, b_p_ta.stack,
+      lambda: tf.zeros(tf.stack([0, shape, self._num_states]), self._dtype))
+    return betta_ta.stack(), b_p
+
+  def _backward_scan(self):
+    # The unscaled betta[n] is any column of the product of the operators
+    # of the frames n + 1, ..., N - 1 and of a matrix of ones. The scaled
+    # betta[n] of the recursion is divided by c[n + 1] ... c[N - 1].
+    ops = self._transition_operators()
+    ops = tf.concat([ops[1:], tf.ones_like(ops[:1])], axis=0)
+    prod, log_scale = self._scan_products(ops, reverse=True)
+    log_z = tf.cumsum(tf.log(self._c), axis=0)
+    betta = prod[..., 0] * tf.exp(
+      tf.expand_dims(log_scale, -1) + log_z - log_z[-1])
+    em = tf.transpose(self._emissions, perm=[1, 0, 2])
+    return betta, betta[1:] * em[1:]
 
   def _expectation(self):
     with tf.variable_scope('expectation'):
       # gamma shape : (N, I, states)
-      self._gamma = tf.multiply(self._alpha, self._betta, name='gamma')
-      n = tf.shape(self._dataset_tf)[1]
-      shape = tf.shape(self._dataset_tf)[0]
-      dims = tf.stack([shape, self._num_states, self._num_states])
-      xi_tmp_ = tf.fill(dims, 1.0)
-      xi_0 = tf.expand_dims(tf.ones_like(xi_tmp_, dtype=tf.float64), 0)
-      i0 = tf.constant(1)
-      condition_xi = lambda i, xi: tf.less(i, n)
-      _, xi_tmp = tf.while_loop(
-        condition_xi, self._xi_calc, [i0, xi_0],
-        shape_invariants=[i0.get_shape(), tf.TensorShape(
-          [None, None, self._num_states, self._num_states])])
-      self._xi = xi_tmp[1:, :, :]
-
-  def _maximization(self):
-    with tf.variable_scope('maximization'):
-      max_var = 20.0
-      gamma_mv = tf.reduce_mean(self._gamma, axis=1, name='gamma_mv')
-      # self._gamma_mv = gamma_mv
-      # print('gamma_mv shape : ', gamma_mv.get_shape())
-      xi_mv = tf.reduce_mean(self._xi, axis=1, name='xi_mv')
-      # update the initial state probabilities
-      self._p0_tf_new = tf.transpose(tf.expand_dims(gamma_mv[0], -1))
-      # update the transition matrix
-      # first calculate sum_n=2^{N} xi_mean[n-1,k , n,l]
-      sum_xi_mean = tf.squeeze(tf.reduce_sum(xi_mv, axis=0))
-      self._tp_tf_new = sum_xi_mean / (tf.reduce_sum(sum_xi_mean,
-                                                     axis=1,
-                                                     keepdims=True))
-
-      # emissions update
-      x_t = tf.transpose(self._dataset_tf, perm=[1, 0, 2], name='x_transpose')
-      gamma_x = tf.matmul(tf.expand_dims(self._gamma, -1),
-                          tf.expand_dims(x_t, -1), transpose_b=True)
-      sum_gamma_x = tf.reduce_sum(gamma_x, axis=[0, 1])
-      mu_tmp_t = tf.transpose(sum_gamma_x) / tf.reduce_sum(
-        self._gamma,
-        axis=[0, 1])
-      self._mu_tf_new = tf.transpose(mu_tmp_t)
-      # update the covariances
+      mask = tf.expand_dims(tf.transpose(self._mask_tf), -1)
+      self._gamma = tf.multiply(
+        self._alpha, self._betta * mask, name='gamma')
+      # xi[n - 1] = (alpha[n - 1] / c[n]) b_p[n - 1]^T * tp, n = 1, ..., N - 1,
+      # summed over time, so that no (N - 1, I, states, states) array is
+      # formed : xi shape : (I, states, states)
+      a_c = self._alpha[:-1] / self._c[1:] * mask[1:]
+      if self._banded:
+        # only the band of xi is computed, in O(states) per frame
+        xi_stay = tf.reduce_sum(a_c * self._b_p, axis=0) * self._tp_stay
+        xi_move = tf.reduce_sum(
+          a_c * self._roll_states(self._b_p, -1), axis=0) * self._tp_move
+        self._xi = tf.add(
+          tf.matrix_diag(xi_stay),
+          self._roll_states(tf.matrix_diag(xi_move), 1), name='xi')
+      else:
+        self._xi = tf.multiply(
+          tf.matmul(tf.transpose(a_c, perm=[1, 2, 0]),
+                    tf.transpose(self._b_p, perm=[1, 0, 2])),
+          self._tp_tf, name='xi')
+
+  def _sufficient_statistics(self):
+    with tf.variable_scope('statistics'):
       # gamma shape : (N, I, states)
+      # xi shape : (N - 1, I, states, states)
       # x shape : (I, N, dim)
       # mu shape : (states, dim)
-      x_expanded = tf.expand_dims(self._dataset_tf, -2)
-      # calculate (x - mu) tensor : expected shape (I, N, states, dim)
-      x_m_mu = tf.subtract(x_expanded, self._mu_tf)
-      # calculate (x - mu)(x - mu)^T : expected shape (I, N, states, dim, dim)
-      x_m_mu_2 = tf.matmul(tf.expand_dims(x_m_mu, -1),
-                           tf.expand_dims(x_m_mu, -2))
-      gamma_r = tf.transpose(self._gamma, perm=[1, 0, 2])
-      gamma_x_m_mu_2 = tf.multiply(
-                          x_m_mu_2,
-                          tf.expand_dims(tf.expand_dims(gamma_r, -1), -1))
-      _new_cov_tmp = tf.reduce_sum(
-        gamma_x_m_mu_2,
-        axis=[0, 1]) / tf.expand_dims(
-        tf.expand_dims(
-          tf.reduce_sum(
-            gamma_r,
-            axis=[0, 1]), -1), -1)
-      lowest_var = (0.5 * max_var + self._min_var_tf) * \
-          tf.tile(
-            tf.expand_dims(
-              tf.Variable(
-                initial_value=np.identity(
-                  self._data_dim,
-                  dtype=np.float64),
-                dtype=tf.float64), 0),
-            [self._num_states, 1, 1])
-      lowest_cov = -0.5 * max_var * tf.ones(
-        [self._num_states, self._data_dim, self._data_dim], dtype=tf.float64)
-      lowest_c = tf.add(lowest_cov, lowest_var)
-      highest_var = (-0.5 * max_var + max_var) * \
-          tf.tile(
-            tf.expand_dims(
-              tf.Variable(
-                  initial_value=np.identity(
-                    self._data_dim,
-                    dtype=np.float64),
-                  dtype=tf.float64), 0),
-            [self._num_states, 1, 1])
-      highest_cov = 0.5 * max_var * tf.ones(
-        [self._num_states, self._data_dim, self._data_dim], dtype=tf.float64)
-      highest_c = tf.add(highest_cov, highest_var)
-      _new_cov_tmp2 = tf.maximum(lowest_c, _new_cov_tmp)
-      self._sigma_tf_new = tf.minimum(highest_c, _new_cov_tmp2)
-
-  def _viterbi_step(self, n, w, am):
-    w_tmp = tf.expand_dims(tf.log(self._emissions[:, n]) + tf.reduce_max(
-          tf.expand_dims(w[:, n - 1], -1) + tf.expand_dims((tf.log(self._tp_tf)), 0) , axis=-2), 1)
-    am_tmp = tf.expand_dims(tf.argmax(tf.expand_dims(w[:, n - 1], -1) + tf.expand_dims((tf.log(self._tp_tf)), 0) , axis=-2), 1)
-    return [n + 1, tf.concat([w, w_tmp], 1), tf.concat([am, am_tmp], 1)]
+      # the frames of all the sequences are flattened, so that the weighted
+      # moments are contractions over the frames and no per frame outer
+      # product of shape (I, N, states, dim, dim) is ever formed
+      # the statistics are sums over all the frames, they are accumulated
+      # in float64 whatever the dtype
+      gamma_f = tf.cast(tf.reshape(
+        tf.transpose(self._gamma, perm=[1, 0, 2]), [-1, self._num_states]),
+        tf.float64)
+      x_f = tf.cast(
+        tf.reshape(self._dataset_tf, [-1, self._data_dim]), tf.float64)
+      mu = tf.cast(self._mu_tf, tf.float64)
+      # sum_n gamma[n, k] x[n] : shape (states, dim)
+      gamma_x = tf.matmul(gamma_f, x_f, transpose_a=True)
+
+      # sum_n gamma[n, k] (x[n] - mu[k])(x[n] - mu[k])^T, one state at a
+      # time : shape (states, dim, dim), or only its diagonal for the
+      # diagonal and spherical covariances : shape (states, dim)
+      def gamma_x_m_mu_2(elems):
+        gamma_k, mu_k = elems
+        x_m_mu = x_f - mu_k
+        if self._covariance_type in ('diag', 'spherical'):
+          return tf.matmul(
+            tf.expand_dims(gamma_k, 0), tf.square(x_m_mu))[0]
+        return tf.matmul(
+          x_m_mu * tf.expand_dims(gamma_k, -1), x_m_mu, transpose_a=True)
+      gamma_x_m_mu_2_sum = tf.map_fn(
+        gamma_x_m_mu_2, (tf.transpose(gamma_f), mu),
+        dtype=tf.float64, parallel_iterations=1)
+      # the statistics are sums over sequences and time, so that they can
+      # be accumulated over chunks of the data before the maximization step
+      self._stats = {
+        'num_sequences': tf.cast(tf.shape(self._dataset_tf)[0], tf.float64),
+        'log_likelihood': tf.reduce_sum(
+          tf.cast(self._posterior, tf.float64)),
+        'gamma_0': tf.reduce_sum(tf.cast(self._gamma[0], tf.float64), axis=0),
+        'xi': tf.reduce_sum(tf.cast(self._xi, tf.float64), axis=0),
+        'gamma': tf.reduce_sum(gamma_f, axis=0),
+        'x': gamma_x,
+        'xx': gamma_x_m_mu_2_sum}
+
+  def _best_previous(self, w_prev):
+    # the best score of a transition into every state and its previous
+    # state, for path scores w_prev of shape (..., states)
+    if self._banded:
+      states = tf.zeros_like(w_prev, dtype=tf.int64) + tf.range(
+        self._num_states, dtype=tf.int64)
+      w_stay = w_prev + self._log_tp_stay
+      w_move = self._roll_states(w_prev + self._log_tp_move, 1)
+      # ties go to the lowest state index, as with the dense argmax
+      take_move = tf.logical_or(
+        w_move > w_stay, tf.logical_and(tf.equal(w_move, w_stay), states > 0))
+      return (tf.where(take_move, w_move, w_stay),
+              tf.where(take_move, tf.mod(states - 1, self._num_states), states))
+    w_tp = tf.expand_dims(w_prev, -1) + self._log_tp
+    return tf.reduce_max(w_tp, axis=-2), tf.argmax(w_tp, axis=-2)
+
+  def _viterbi_step(self, n, w_prev, w, am):
+    w_best, am_tmp = self._best_previous(w_prev)
+    w_tmp = self._viterbi_log_em[:, n] + w_best
+    # the padded frames keep the scores and point back to the same state
+    valid = self._mask_tf[:, n] > 0
+    w_tmp = tf.where(valid, w_tmp, w_prev)
+    am_tmp = tf.where(valid, am_tmp, tf.zeros_like(am_tmp) + tf.range(
+      self._num_states, dtype=tf.int64))
+    return [n + 1, w_tmp, w.write(n, w_tmp), am.write(n, am_tmp)]
 
   def _viterbi(self):
     with self._graph.as_default():
-      m = tf.shape(self._dataset_tf)[0]
-      n = tf.shape(self._dataset_tf)[1]
-      w1 = tf.expand_dims(
-        tf.log(self._p0_tf) + tf.log(self._emissions[:, 0]), 1)
-      am1 = tf.zeros_like(w1, dtype='int64')
-      i0 = tf.constant(1)
-      condition_viterbi = lambda i, w, am: tf.less(i, n)
-      _, self._w, self._am = tf.while_loop(
-        condition_viterbi, self._viterbi_step, [i0, w1, am1], shape_invariants=[
-          i0.get_shape(), tf.TensorShape([None, None, self._num_states]), tf.TensorShape([None, None, self._num_states])])
+      # the path scores are sums over all the frames, they are accumulated
+      # in float64 whatever the dtype
+      self._viterbi_log_em = tf.cast(self._log_emissions, tf.float64)
+      self._log_p0 = tf.log(tf.cast(self._p0_tf, tf.float64))
+      self._log_tp = tf.log(tf.cast(self._tp_tf, tf.float64))
+      if self._banded:
+        self._log_tp_stay = tf.log(tf.cast(self._tp_stay, tf.float64))
+        self._log_tp_move = tf.log(tf.cast(self._tp_move, tf.float64))
+      # w, am shape : (I, N, states)
+      self._w, self._am = tf.cond(
+        self._scan_tf, self._viterbi_scan, self._viterbi_recursion)
+
+  def _viterbi_recursion(self):
+    n = tf.shape(self._dataset_tf)[1]
+    w1 = self._log_p0 + self._viterbi_log_em[:, 0]
+    am1 = tf.zeros_like(w1, dtype='int64')
+    w_ta = tf.TensorArray(
+      tf.float64, size=n,
+      element_shape=tf.TensorShape([None, self._num_states])).write(0, w1)
+    am_ta = tf.TensorArray(
+      tf.int64, size=n,
+      element_shape=tf.TensorShape([None, self._num_states])).write(0, am1)
+    i0 = tf.constant(1)
+    condition_viterbi = lambda i, w_prev, w, am: tf.less(i, n)
+    _, _, w_ta, am_ta = tf.while_loop(
+      condition_viterbi, self._viterbi_step, [i0, w1, w_ta, am_ta],
+      shape_invariants=[
+        i0.get_shape(), tf.TensorShape([None, self._num_states]),
+        tf.TensorShape(None), tf.TensorShape(None)])
+    return (tf.transpose(w_ta.stack(), perm=[1, 0, 2]),
+            tf.transpose(am_ta.stack(), perm=[1, 0, 2]))
+
+  def _viterbi_scan(self):
+    # w[n] is the first row of the max-plus product of the log-scale
+    # operators of the frames 0, ..., n, with the max-plus identity on the
+    # padded frames, and the back pointers of all the frames follow at once
+    valid = tf.transpose(self._mask_tf) > 0
+    log_identity = tf.log(tf.eye(self._num_states, dtype=tf.float64))
+    log_em = tf.transpose(self._viterbi_log_em, perm=[1, 0, 2])
+    ops = tf.expand_dims(log_em, -2) + self._log_tp
+    op_0 = tf.expand_dims(log_em[0] + self._log_p0, -2) + tf.zeros(
+      [self._num_states, 1], dtype=tf.float64)
+    ops = tf.concat([tf.expand_dims(op_0, 0), ops[1:]], axis=0)
+    ops = tf.where(
+      tf.tile(tf.expand_dims(tf.expand_dims(valid, -1), -1),
+              [1, 1, self._num_states, self._num_states]),
+      ops, tf.zeros_like(ops) + log_identity)
+    prod, _ = self._scan_products(ops, combine=self._max_plus)
+    w = tf.transpose(prod[:, :, 0], perm=[1, 0, 2])
+    _, am = self._best_previous(w[:, :-1])
+    # the padded frames point back to the same state
+    states = tf.zeros_like(am) + tf.range(self._num_states, dtype=tf.int64)
+    am = tf.where(
+      tf.tile(tf.expand_dims(tf.transpose(valid)[:, 1:], -1),
+              [1, 1, self._num_states]), am, states)
+    # the first frame has no previous state, also for single frames
+    return w, tf.concat([tf.zeros_like(w[:, :1], dtype=tf.int64), am], axis=1)
+
+  def _posterior_batch(self, batch, mask):
+    if self._backend == 'numpy':
+      p0, tp, mu, factors = self._numpy_params()
+      return numpy_backend.posterior(
+        batch.astype(self._dtype, copy=False), p0, tp, mu, self._sigma, mask,
+        self._covariance_type, self._banded, factors,
+        self._use_scan(batch.shape))
+    return self._run(self._posterior, self._data_feed(batch, mask))[:, 0]
+
+  def _viterbi_batch(self, batch, mask):
+    if self._backend == 'numpy':
+      p0, tp, mu, factors = self._numpy_params()
+      return numpy_backend.viterbi(
+        batch.astype(self._dtype, copy=False), p0, tp, mu, self._sigma, mask,
+        self._covariance_type, self._banded, factors,
+        self._use_scan(batch.shape))
+    return self._run([self._w, self._am], self._data_feed(batch, mask))
+
+  def _smooth_batch(self, batch, mask):
+    # gamma shape : (I, N, states), xi shape : (I, states, states)
+    if self._backend == 'numpy':
+      p0, tp, mu, factors = self._numpy_params()
+      return numpy_backend.smooth(
+        batch.astype(self._dtype, copy=False), p0, tp, mu, self._sigma, mask,
+        self._covariance_type, self._banded, factors)
+    gamma, xi = self._run([self._gamma, self._xi], self._data_feed(batch, mask))
+    return np.transpose(gamma, (1, 0, 2)), xi
+
+  def _numpy_params(self):
+    # the parameters of the numpy backend in the precision of the model
+    factors = tuple(factor.astype(self._dtype, copy=False)
+                    for factor in self._gaussian_factors())
+    return (self._p0.astype(self._dtype, copy=False),
+            self._tp.astype(self._dtype, copy=False),
+            self._mu.astype(self._dtype, copy=False), factors)
+
+  def _output_array(self, out, shape):
+    # the array that receives a result of the given shape
+    if out is None:
+      return np.empty(shape, dtype=self._dtype)
+    if isinstance(out, str):
+      return np.lib.format.open_memmap(
+        out, mode='w+', dtype=self._dtype, shape=shape)
+    if out.shape != tuple(shape):
+      raise ValueError('out must have the shape ' + str(tuple(shape)))
+    return out
+
+  def _data_feed(self, batch, mask):
+    feed_dict = {self._dataset_tf: batch,
+                 self._scan_tf: self._use_scan(batch.shape)}
+    if mask is not None:
+      feed_dict[self._mask_tf] = mask
+    return feed_dict
+
+  def _use_scan(self, shape):
+    # the scans pay off for a few long sequences of models with few states
+    if self._recursion != 'auto':
+      return self._recursion == 'scan'
+    num_seq, length = shape[:2]
+    return (length >= SCAN_MIN_LENGTH and
+            num_seq * self._num_states ** 3 <= SCAN_MAX_WORK and
+            num_seq * length * self._num_states ** 2 <= SCAN_MAX_ENTRIES)
+
+  def _backtrace(self, w, am):
+    # w, am shape : (I, N, states)
+    # the paths of all the sequences are traced back together, one time
+    # step at a time, into a preallocated array
+    num_seq, length = am.shape[:2]
+    rows = np.arange(num_seq)
+    path = np.empty((num_seq, length), dtype='int16')
+    path[:, -1] = np.argmax(w[:, -1], axis=-1)
+    for n in range(length - 1, 0, -1):
+      path[:, n - 1] = am[rows, n, path[:, n]]
+    return path, np.max(w[:, -1], axis=-1)
+
+  def _initialization(self, source, chunk_size):
+    # the data driven part of the initialization, shared by all the
+    # training realizations. It runs on a uniform sample of frames of the
+    # whole data, so its cost depends neither on the length of the
+    # sequences nor on the number of realizations.
+    from sklearn.cluster import MiniBatchKMeans
+    INIT_NUM_FRAMES = 10000
+    frames, positions = sources.sample_frames(
+      source, INIT_NUM_FRAMES, chunk_size)
+    if self._hmm_type != 'left-to-right':
+      kmeans = MiniBatchKMeans(
+        n_clusters=self._num_states, init='k-means++', n_init=3,
+        batch_size=1024, random_state=np.random.randint(2 ** 31 - 1))
+      kmeans.fit(frames)
+      return {'centers': kmeans.cluster_centers_,
+              'scale': np.std(frames, axis=0)}
+    # the states follow each other, every state starts from the frames of
+    # its segment of relative positions
+    bins = np.minimum((positions * self._num_states).astype(np.int64),
+                      self._num_states - 1)
+    centers = np.empty((self._num_states, self._data_dim), dtype=np.float64)
+    variances = np.empty((self._num_states, self._data_dim), dtype=np.float64)
+    for k in range(self._num_states):
+      segment = frames[bins == k]
+      if segment.shape[0] < 2:
+        segment = frames
+      centers[k] = np.mean(segment, axis=0)
+      variances[k] = np.var(segment, axis=0)
+    variances *= 1.0 + 0.3 * np.abs(
+      np.random.randn(self._num_states, self._data_dim))
+    return {'centers': centers, 'sigma': self._diag_covariances(variances)}
+
+  def _fit_run(self, r, seed, source, init, max_steps, batch_size, TOL,
+               min_var, chunk_size, eval_every, validation, rtol, callback,
+               e_step, stepwise, step_size):
+    # a single training realization, returns its best parameters and its
+    # history
+    tic = time.time()
+    if seed is not None:
+      np.random.seed(seed)
+    converged = False
+    stopped = False
+    post_max = -np.inf
+    post_prev = None
+    records = []
+    # the running statistics and the number of updates of stepwise EM
+    running = {'stats': {}, 'updates': 0}
+    if self._hmm_type == 'left-to-right':
+      self._mu = np.multiply(init['centers'], 1.0 + 0.05 * np.random.randn(
+        self._num_states, self._data_dim))
+      self._sigma = np.copy(init['sigma'])
+    else:
+      # the shared k-means centers, perturbed for every realization
+      self._mu = init['centers'] + 0.05 * init['scale'] * np.random.randn(
+        self._num_states, self._data_dim)
+      self._sigma = self._diag_covariances(
+        np.ones((self._num_states, self._data_dim), dtype=np.float64))
+    self._p0, self._tp = self._init_p0_tp()
+    self._params_version += 1
+    init_time = time.time() - tic
+    with tf.Session(graph=self._graph, config=self._session_config) as sess:
+      sess.run(self._init_op)
+      for step in range(max_steps):
+        step_tic = time.time()
+        if stepwise:
+          # the mini-batches come in a new random order at every pass
+          chunks = source.chunks(batch_size or chunk_size, shuffle=True)
+        elif batch_size is None:
+          chunks = source.chunks(chunk_size)
+        else:
+          chunks = [source.get_batch(batch_size)]
+        if step == 0:
+          p0_prev = np.zeros((self._num_states,))
+          tp_prev = np.zeros((self._num_states, self._num_states))
+          mu_prev = np.zeros((self._num_states, self._data_dim,))
+          sigma_prev = np.zeros(self._sigma.shape)
+        else:
+          p0_prev = self._p0
+          tp_prev = self._tp
+          mu_prev = self._mu
+          sigma_prev = self._sigma
+        if stepwise:
+          # the parameters of the expectation steps change within the
+          # pass, the parameters at its end stand for it
+          update = self._stepwise_pass(sess, chunks, running, step_size,
+                                       min_var)
+          log_likelihood = update['log_likelihood']
+          num_updates, j = update['updates'], update['repairs']
+          e_step_toc = step_tic + update['time']['e_step']
+          m_step_toc = e_step_toc + update['time']['m_step']
+          repair_toc = m_step_toc + update['time']['repair']
+          if not eval_every:
+            post = log_likelihood
+            if post > post_max:
+              post_max = post
+              params_max = (self._p0, self._tp, self._mu, self._sigma)
+        else:
+          if e_step is not None and batch_size is None:
+            stats = e_step.statistics(self)
+          else:
+            stats = self._accumulate_statistics(sess, chunks)
+          e_step_toc = time.time()
+          # the log-likelihood of the parameters of the expectation step
+          log_likelihood = stats['log_likelihood'] / stats['num_sequences']
+          if not eval_every:
+            post = log_likelihood
+            if post > post_max:
+              post_max = post
+              params_max = (self._p0, self._tp, self._mu, self._sigma)
+          self._p0, self._tp, self._mu, self._sigma = self._maximization(
+            stats, min_var)
+          m_step_toc = time.time()
+          num_updates, j = 1, self._repair_covariances()
+          # the factors of the new parameters are computed once, at their
+          # first use
+          self._params_version += 1
+          repair_toc = time.time()
+        evaluated = eval_every and (step + 1) % eval_every == 0
+        if evaluated:
+          # the log-likelihood of the updated parameters
+          post = self._evaluate(sess, source, validation, chunk_size, e_step)
+          if post > post_max:
+            post_max = post
+            params_max = (self._p0, self._tp, self._mu, self._sigma)
+        evaluation_toc = time.time()
+        ch_p0 = np.max(np.abs(self._p0 - p0_prev))
+        ch_tp = np.max(np.abs(self._tp - tp_prev))
+        ch_mu = np.max(np.abs(self._mu - mu_prev))
+        ch_sigma = np.max(np.abs(self._sigma - sigma_prev))
+        if rtol is None:
+          converged = (ch_p0 < TOL and ch_tp < TOL and ch_mu < TOL
+                       and ch_sigma < TOL)
+        elif evaluated or not eval_every:
+          converged = (post_prev is not None and
+                       post - post_prev < rtol * np.abs(post_prev))
+          post_prev = post
+        record = {
+          'run': r, 'step': step,
+          'log_likelihood': float(log_likelihood),
+          'eval_log_likelihood': float(post) if evaluated else None,
+          'deltas': {'p0': float(ch_p0), 'tp': float(ch_tp),
+                     'mu': float(ch_mu), 'sigma': float(ch_sigma)},
+          'repairs': j, 'updates': num_updates,
+          'step_size': running.get('step_size'),
+          'time': {'e_step': e_step_toc - step_tic,
+                   'm_step': m_step_toc - e_step_toc,
+                   'repair': repair_toc - m_step_toc,
+                   'evaluation': evaluation_toc - repair_toc,
+                   'total': evaluation_toc - step_tic},
+          'peak_rss_mb': _peak_rss_mb()}
+        records.append(record)
+        if callback is not None:
+          stopped = bool(callback(record)) and not converged
+        if converged or stopped:
+          break
+      if eval_every and not evaluated:
+        post = self._evaluate(sess, source, validation, chunk_size, e_step)
+        if post > post_max:
+          post_max = post
+          params_max = (self._p0, self._tp, self._mu, self._sigma)
+      elif not eval_every and post >= post_max:
+        # an EM step does not decrease the log-likelihood, so the last update
+        # is kept over the parameters of its expectation step
+        params_max = (self._p0, self._tp, self._mu, self._sigma)
+    history = {'run': r, 'seed': seed, 'steps': records,
+               'converged': converged, 'stopped': stopped,
+               'log_likelihood': float(post_max),
+               'time': {'initialization': init_time,
+                        'total': time.time() - tic}}
+    return {'params': params_max, 'post': post_max, 'converged': converged,
+            'history': history}
+
+  def _stepwise_pass(self, sess, chunks, running, step_size, min_var):
+    # a pass of stepwise EM, every chunk blends its statistics per sequence
+    # into the running statistics and updates the parameters from them
+    total = 0.0
+    num = 0
+    updates = 0
+    repairs = 0
+    times = {'e_step': 0.0, 'm_step': 0.0, 'repair': 0.0}
+    for batch, mask in chunks:
+      tic = time.time()
+      stats = self._accumulate_statistics(sess, [(batch, mask)])
+      e_step_toc = time.time()
+      total += stats['log_likelihood']
+      num += stats['num_sequences']
+      if callable(step_size):
+        eta = step_size(running['updates'])
+      else:
+        eta = (running['updates'] + 2.0) ** -step_size
+      running['stats'] = {
+        key: (1.0 - eta) * running['stats'].get(key, 0.0) +
+        eta * value / stats['num_sequences'] for key, value in stats.items()}
+      running['updates'] += 1
+      running['step_size'] = float(eta)
+      updates += 1
+      self._p0, self._tp, self._mu, self._sigma = self._maximization(
+        running['stats'], min_var)
+      m_step_toc = time.time()
+      repairs += self._repair_covariances()
+      self._params_version += 1
+      times['e_step'] += e_step_toc - tic
+      times['m_step'] += m_step_toc - e_step_toc
+      times['repair'] += time.time() - m_step_toc
+    if num == 0:
+      raise ValueError('the training data is empty')
+    return {'log_likelihood': total / num, 'repairs': repairs,
+            'updates': updates, 'time': times}
+
+  def _parallel_fit_runs(self, n_jobs, seeds, fit_args):
+    # runs the training realizations in a pool of n_jobs worker processes
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    num_threads = max(1, _num_cpus() // n_jobs)
+    config = (self._num_states, self._data_dim, self._hmm_type,
+              self._covariance_type, self._recursion, self._dtype,
+              num_threads)
+    with ProcessPoolExecutor(
+        max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_fit_worker, initargs=(config, fit_args)) as pool:
+      return list(pool.map(_fit_worker, range(len(seeds)), seeds))
+
+  def _accumulate_statistics(self, sess, chunks):
+    # runs the expectation step chunk by chunk and sums the statistics
+    stats = None
+    for batch, mask in chunks:
+      feed_dict = self._data_feed(batch, mask)
+      feed_dict.update(self._params_feed())
+      chunk_stats = sess.run(self._stats, feed_dict=feed_dict)
+      if stats is None:
+        stats = chunk_stats
+      else:
+        for key in stats:
+          stats[key] += chunk_stats[key]
+    return stats
+
+  def _maximization(self, stats, min_var):
+    max_var = 20.0
+    identity = np.identity(self._data_dim, dtype=np.float64)
+    # update the initial state probabilities
+    p0 = np.expand_dims(stats['gamma_0'] / stats['num_sequences'], 0)
+    # update the transition matrix
+    tp = stats['xi'] / np.sum(stats['xi'], axis=1, keepdims=True)
+    # update the emissions
+    mu = stats['x'] / np.expand_dims(stats['gamma'], -1)
+    if self._covariance_type in ('diag', 'spherical'):
+      sigma = stats['xx'] / np.expand_dims(stats['gamma'], -1)
+      if self._covariance_type == 'spherical':
+        sigma = np.mean(sigma, axis=-1)
+      # the variances lie in [min_var, max_var]
+      return p0, tp, mu, np.clip(sigma, min_var, max_var)
+    if self._covariance_type == 'tied':
+      sigma = np.sum(stats['xx'], axis=0) / np.sum(stats['gamma'])
+    else:
+      sigma = stats['xx'] / np.expand_dims(
+        np.expand_dims(stats['gamma'], -1), -1)
+    # the variances lie in [min_var, max_var] and the covariances
+    # in [-max_var / 2, max_var / 2]
+    lowest_c = (0.5 * max_var + min_var) * identity - 0.5 * max_var
+    highest_c = 0.5 * max_var * identity + 0.5 * max_var
+    sigma = np.minimum(highest_c, np.maximum(lowest_c, sigma))
+    return p0, tp, mu, sigma
+
+  def _evaluate(self, sess, source, validation, chunk_size, e_step):
+    # the mean log-likelihood of the validation data, or of the training
+    # data if there is none
+    if e_step is not None:
+      return e_step.mean_posterior(self)
+    total, num = self._posterior_sum(
+      sess, (validation or source).chunks(chunk_size))
+    return total / num
+
+  def _posterior_sum(self, sess, chunks):
+    total = 0.0
+    num = 0
+    for batch, mask in chunks:
+      feed_dict = self._data_feed(batch, mask)
+      feed_dict.update(self._params_feed())
+      total += np.sum(sess.run(self._posterior, feed_dict=feed_dict))
+      num += batch.shape[0]
+    return total, num
+
+  def _repair_covariances(self):
+    # check if the sigma is positive definite, the diagonal and spherical
+    # covariances are after the maximization step, returns the number of
+    # repairs
+    j = 0
+    if self._covariance_type in ('full', 'tied'):
+      sigma = np.reshape(self._sigma, (-1, self._data_dim, self._data_dim))
+      for k in range(sigma.shape[0]):
+        while not self._is_pos_def(sigma[k]):
+          j += 1
+          sigma[k] = sigma[k] + 0.05 * np.array(
+            [np.identity(self._data_dim, dtype=np.float64)])*sigma[k]
+    return j
 
   def _is_pos_def(self, sigma):
-    return np.all(np.linalg.eigvals(sigma) > 0.02)
+    # the eigenvalues are above 0.02 if and only if sigma - 0.02 I has a
+    # Cholesky factorization, which is cheaper than the eigenvalues
+    try:
+      np.linalg.cholesky(sigma - 0.02 * np.identity(self._data_dim))
+    except np.linalg.LinAlgError:
+      return False
+    return True
+
+  def _gaussian_factors(self):
+    # the Cholesky factors, inverse factors and log-determinants of the
+    # covariances, rebuilt only when the parameters change
+    if self._factors_version != self._params_version:
+      self._factors = numpy_backend.gaussian_factors(
+        self._sigma, self._covariance_type, self._data_dim)
+      self._factors_version = self._params_version
+    return self._factors
+
+  @classmethod
+  def _from_file(cls, filename, backend, mmap):
+    # the model of a file of save_model and the bytes of its arrays
+    config, arrays = store.read_model(filename, mmap=mmap)
+    model = cls(config['num_states'], config['data_dim'], config['hmm_type'],
+                backend=backend, covariance_type=config['covariance_type'],
+                recursion=config['recursion'], dtype=config['dtype'])
+    model._set_params(config, arrays)
+    return model, sum(value.nbytes for value in arrays.values())
+
+  def _set_params(self, config, arrays):
+    # the parameters and, if given, the factors of the covariances
+    self._p0 = arrays['p0']
+    self._tp = arrays['tp']
+    self._mu = arrays['mu']
+    self._sigma = arrays['sigma']
+    self._epoch = max(config['epoch'], 1)
+    self._params_version += 1
+    if 'log_det' in arrays:
+      self._factors = (arrays['scale'], arrays['inv_scale'], arrays['log_det'])
+      self._factors_version = self._params_version
 
   def _init_p0_tp(self):
     tp = np.ones([self._num_states, self._num_states], dtype=np.float64) / self._num_states
@@ -581,5 +1661,18 @@ class HMM(object):
       tp[-1, 0] = 0.5
       tp[-1, -1] = 0.5
       p0 = np.ones([1, self._num_states], dtype=np.float64) / self._num_states
+      # a single cyclic state moves back to itself
+      tp /= np.sum(tp, axis=1, keepdims=True)
     return p0, tp
+
+  def _diag_covariances(self, variances):
+    # the covariances of the covariance type with the (states, dim)
+    # variances on their diagonal
+    if self._covariance_type == 'full':
+      return np.array([np.diag(v) for v in variances])
+    if self._covariance_type == 'diag':
+      return variances
+    if self._covariance_type == 'spherical':
+      return np.mean(variances, axis=-1)
+    return np.diag(np.mean(variances, axis=0))
      
@@ -0,0 +1,523 @@
+"""Pure NumPy implementation of the HMM inference and generation routines.
+
+The functions in this module mirror the TensorFlow graph of the HMM class
+and share its conventions: emissions are laid out as (I, N, states), the
+forward variables as (N, I, states) and the viterbi variables as
+(I, N, states). Importing this module does not import TensorFlow.
+
+The covariances are stored in the form of their covariance type: 'full'
+(states, dim, dim), 'diag' (states, dim), 'spherical' (states,) and
+'tied' (dim, dim), shared by all the states.
+"""
+import numpy as np
+
+LOG_2PI = np.log(2.0 * np.pi)
+
+
+def full_covariances(sigma, covariance_type, num_states, data_dim):
+  """Expands the covariances of a covariance type to full matrices.
+
+  Args:
+    sigma: The covariances in the form of covariance_type.
+    covariance_type: One of 'full', 'diag', 'spherical' and 'tied'.
+    num_states: Number of the hidden states.
+    data_dim: Dimensionality of the observed data.
+
+  Returns:
+    The covariance matrices, shape (states, dim, dim).
+  """
+  if covariance_type == 'full':
+    return sigma
+  if covariance_type == 'tied':
+    return np.array([sigma] * num_states)
+  if covariance_type == 'spherical':
+    sigma = np.expand_dims(sigma, -1)
+  # diagonal matrices, shape (states, dim, dim)
+  return np.expand_dims(sigma, -1) * np.identity(data_dim)
+
+
+def gaussian_factors(sigma, covariance_type='full', data_dim=None):
+  """Factorizes the covariances of the states.
+
+  Args:
+    sigma: The covariances in the form of covariance_type.
+    covariance_type: One of 'full', 'diag', 'spherical' and 'tied'.
+    data_dim: Dimensionality of the observed data, only needed by the
+      spherical covariances.
+
+  Returns:
+    The scale factors, the inverse scale factors and the log-determinants
+    of the covariances. The scale factors are Cholesky factors, shape
+    (states, dim, dim), for full covariances, shape (1, dim, dim) for tied
+    covariances, and the standard deviations, shape (states, dim) or
+    (states, 1), for diagonal and spherical covariances. The inverse scale
+    factors have the same shapes. The log-determinants have shape
+    (states,), or (1,) for tied covariances.
+  """
+  if covariance_type in ('diag', 'spherical'):
+    var = np.asarray(sigma, dtype=np.float64)
+    if covariance_type == 'spherical':
+      var = np.expand_dims(var, -1)
+      log_det = data_dim * np.log(var[:, 0])
+    else:
+      log_det = np.sum(np.log(var), -1)
+    scale = np.sqrt(var)
+    return scale, 1.0 / scale, log_det
+  if covariance_type == 'tied':
+    sigma = np.expand_dims(sigma, 0)
+  chol = np.linalg.cholesky(sigma)
+  log_det = 2.0 * np.sum(np.log(np.diagonal(chol, axis1=-2, axis2=-1)), -1)
+  return chol, np.linalg.inv(chol), log_det
+
+
+def log_emissions(data, mu, sigma, factors=None, covariance_type='full'):
+  """Evaluates the Gaussian log-densities of every frame under every state.
+
+  Args:
+    data: A numpy array of shape (..., dim).
+    mu: The mean values, shape (states, dim).
+    sigma: The covariances in the form of covariance_type.
+    factors: None or the output of gaussian_factors(sigma, ...).
+    covariance_type: One of 'full', 'diag', 'spherical' and 'tied'.
+
+  Returns:
+    A numpy array of shape (..., states).
+  """
+  num_states, data_dim = mu.shape
+  if factors is None:
+    factors = gaussian_factors(sigma, covariance_type, data_dim)
+  _, inv_scale, log_det = factors
+  # the tied factors are shared by all the states
+  log_det = np.broadcast_to(log_det, (num_states,))
+  if inv_scale.ndim == 2:
+    # diagonal covariances, the quadratic forms of all the states are two
+    # matrix products over the frames, O(dim) per frame and state
+    prec = np.broadcast_to(inv_scale ** 2, (num_states, data_dim))
+    x = np.reshape(data, (-1, data_dim))
+    log_em = np.dot(x * x, -0.5 * prec.T)
+    log_em += np.dot(x, (mu * prec).T)
+    log_em -= 0.5 * (np.sum(mu * mu * prec, axis=-1) + log_det +
+                     data_dim * LOG_2PI)
+    return np.reshape(log_em, data.shape[:-1] + (num_states,))
+  inv_scale = np.broadcast_to(inv_scale, (num_states,) + inv_scale.shape[1:])
+  log_em = np.empty(data.shape[:-1] + (num_states,), dtype=data.dtype)
+  for k in range(num_states):
+    z = np.matmul(data - mu[k], inv_scale[k].T)
+    log_em[..., k] = -0.5 * (
+      np.sum(z * z, axis=-1) + log_det[k] + data_dim * LOG_2PI)
+  return log_em
+
+
+def scaled_emissions(log_em):
+  """Shifts the log-densities by their per frame maximum before exponentiation.
+
+  Args:
+    log_em: The log-densities, shape (..., states).
+
+  Returns:
+    The scaled emission probabilities, shape (..., states), and the
+    subtracted log-scale shift of shape (...).
+  """
+  shift = np.max(log_em, axis=-1)
+  return np.exp(log_em - shift[..., None]), shift
+
+
+def masked_log_emissions(data, mu, sigma, mask=None, covariance_type='full',
+                         factors=None):
+  """Same as log_emissions, with zero log-densities on the padded frames.
+
+  Args:
+    data: A numpy array of shape (I, N, dim).
+    mu, sigma: The emission parameters.
+    mask: None or a (I, N) array with zeros on the padded frames.
+    covariance_type: The covariance type of sigma.
+    factors: None or the output of gaussian_factors(sigma, ...).
+
+  Returns:
+    A numpy array of shape (I, N, states).
+  """
+  log_em = log_emissions(data, mu, sigma, factors, covariance_type)
+  if mask is not None:
+    log_em *= np.expand_dims(mask, -1)
+  return log_em
+
+
+def transition_band(tp):
+  """Extracts the band of a left-to-right or cyclic transition matrix.
+
+  Args:
+    tp: The transition probabilities, shape (..., states, states), which
+      are zero except for tp[k, k] and tp[k, (k + 1) % states].
+
+  Returns:
+    The probabilities to stay, tp[k, k], and to move to the next state,
+    tp[k, (k + 1) % states], both of shape (..., states). A single state
+    only stays, its probability to move is zero.
+  """
+  num_states = tp.shape[-1]
+  states = np.arange(num_states)
+  tp_move = tp[..., states, (states + 1) % num_states]
+  if num_states == 1:
+    tp_move = np.zeros_like(tp_move)
+  return tp[..., states, states], tp_move
+
+
+def forward(em, p0, tp, mask=None, banded=False):
+  """Runs the scaled forward recursion.
+
+  Args:
+    em: The (scaled) emission probabilities, shape (I, N, states), or
+      (I, models, N, states) for a bank of models.
+    p0: The initial probabilities, shape (1, states), or (models, states).
+    tp: The transition probabilities, shape (states, states), or
+      (models, states, states).
+    mask: None or a (I, N) array with zeros on the padded frames, where
+      alpha stays unchanged and c is one.
+    banded: If True, tp is a left-to-right or cyclic transition matrix and
+      every step costs O(states) instead of O(states^2).
+
+  Returns:
+    alpha, shape (N, I, states), and the scaling factors c, shape (N, I),
+    or (N, I, models, states) and (N, I, models) for a bank of models.
+  """
+  length = em.shape[-2]
+  batch_shape = em.shape[:-2]
+  alpha = np.empty((length,) + batch_shape + em.shape[-1:], dtype=em.dtype)
+  c = np.empty((length,) + batch_shape, dtype=em.dtype)
+  if banded:
+    stay, move = transition_band(tp)
+  a_n = em[..., 0, :] * p0
+  for n in range(length):
+    if n > 0 and banded:
+      a_n = em[..., n, :] * (
+        alpha[n - 1] * stay + np.roll(alpha[n - 1] * move, 1, axis=-1))
+    elif n > 0 and tp.ndim == 2:
+      a_n = em[..., n, :] * np.dot(alpha[n - 1], tp)
+    elif n > 0:
+      # a vector-matrix product per model of the bank
+      a_n = em[..., n, :] * np.matmul(
+        np.expand_dims(alpha[n - 1], -2), tp)[..., 0, :]
+    c[n] = np.sum(a_n, axis=-1)
+    alpha[n] = a_n / c[n][..., None]
+    if mask is not None and n > 0:
+      valid = np.reshape(mask[:, n] > 0, (-1,) + (1,) * (len(batch_shape) - 1))
+      alpha[n] = np.where(valid[..., None], alpha[n], alpha[n - 1])
+      c[n] = np.where(valid, c[n], 1.0)
+  return alpha, c
+
+
+def backward(em, tp, c, mask=None, banded=False):
+  """Runs the scaled backward recursion.
+
+  Args:
+    em: The (scaled) emission probabilities, shape (I, N, states).
+    tp: The transition probabilities, shape (states, states).
+    c: The scaling factors of the forward recursion, shape (N, I).
+    mask: None or a (I, N) array with zeros on the padded frames, before
+      which betta is one.
+    banded: If True, tp is a left-to-right or cyclic transition matrix.
+
+  Returns:
+    betta, shape (N, I, states).
+  """
+  length = em.shape[1]
+  betta = np.empty((length,) + em.shape[:1] + em.shape[-1:], dtype=em.dtype)
+  betta[-1] = 1.0
+  if banded:
+    stay, move = transition_band(tp)
+  for n in range(length - 2, -1, -1):
+    b_p = betta[n + 1] * em[:, n + 1]
+    if banded:
+      b_n = b_p * stay + move * np.roll(b_p, -1, axis=-1)
+    else:
+      b_n = np.dot(b_p, tp.T)
+    betta[n] = b_n / c[n + 1][:, None]
+    if mask is not None:
+      betta[n] = np.where(mask[:, n + 1, None] > 0, betta[n], 1.0)
+  return betta
+
+
+def smooth(data, p0, tp, mu, sigma, mask=None, covariance_type='full',
+           banded=False, factors=None):
+  """Runs the forward-backward algorithm.
+
+  Args:
+    data: A numpy array of shape (I, N, dim).
+    p0, tp, mu, sigma: The model parameters.
+    mask: None or a (I, N) array with zeros on the padded frames.
+    covariance_type: The covariance type of sigma.
+    banded: If True, tp is a left-to-right or cyclic transition matrix.
+    factors: None or the output of gaussian_factors(sigma, ...).
+
+  Returns:
+    The posterior probabilities of the states, gamma, shape (I, N, states),
+    zero on the padded frames, and the expected numbers of transitions of
+    every sequence, xi summed over time, shape (I, states, states).
+  """
+  em, _ = scaled_emissions(
+    masked_log_emissions(data, mu, sigma, mask, covariance_type, factors))
+  alpha, c = forward(em, p0, tp, mask, banded)
+  betta = backward(em, tp, c, mask, banded)
+  gamma = alpha * betta
+  # xi[n - 1] = (alpha[n - 1] / c[n]) (betta[n] em[n])^T * tp, summed over
+  # n = 1, ..., N - 1 by a matrix product over time
+  a_c = alpha[:-1] / c[1:, :, None]
+  if mask is not None:
+    gamma *= np.transpose(mask)[..., None]
+    a_c *= np.transpose(mask)[1:, :, None]
+  b_p = betta[1:] * np.transpose(em, (1, 0, 2))[1:]
+  xi = np.matmul(np.transpose(a_c, (1, 2, 0)), np.transpose(b_p, (1, 0, 2)))
+  return np.transpose(gamma, (1, 0, 2)), xi * tp
+
+
+def forward_operators(em, p0, tp, mask=None):
+  """Writes the forward recursion as a product of per-frame operators.
+
+  The unnormalized alpha[n] is any row of ops[0] ops[1] ... ops[n], so the
+  forward recursion is an associative scan over the operators.
+
+  Args:
+    em: The (scaled) emission probabilities, shape (I, N, states).
+    p0: The initial probabilities, shape (1, states).
+    tp: The transition probabilities, shape (states, states).
+    mask: None or a (I, N) array with zeros on the padded frames.
+
+  Returns:
+    The operators, shape (N, I, states, states): ops[0] has p0 em[:, 0] on
+    every row, ops[n] is tp diag(em[:, n]), and the identity on the padded
+    frames.
+  """
+  em = np.transpose(em, (1, 0, 2))
+  ops = tp * em[:, :, None, :]
+  ops[0] = np.expand_dims(np.reshape(p0, (-1,)) * em[0], -2)
+  if mask is not None:
+    ops[np.transpose(mask) == 0] = np.identity(tp.shape[-1])
+  return ops
+
+
+def product_log_likelihood(ops):
+  """Multiplies the forward operators in a balanced tree of normalized
+     matrix products, O(log N) sequential steps instead of N.
+
+  Args:
+    ops: The output of forward_operators, shape (N, I, states, states).
+
+  Returns:
+    The log-likelihood of every sequence, shape (I,), the sum of the
+    logarithms of the scaling factors c of the forward recursion.
+  """
+  num_states = ops.shape[-1]
+  scale = np.sum(ops, axis=(-2, -1))
+  prod = ops / scale[..., None, None]
+  # the logarithms of the normalizations are summed in float64
+  log_scale = np.log(scale).astype(np.float64)
+  while prod.shape[0] > 1:
+    if prod.shape[0] % 2:
+      # an identity operator completes the last pair
+      prod = np.concatenate([prod, np.broadcast_to(
+        np.identity(num_states, dtype=prod.dtype), (1,) + prod.shape[1:])])
+      log_scale = np.concatenate(
+        [log_scale, np.zeros((1,) + log_scale.shape[1:], dtype=log_scale.dtype)])
+    prod = np.matmul(prod[0::2], prod[1::2])
+    scale = np.sum(prod, axis=(-2, -1))
+    prod /= scale[..., None, None]
+    log_scale = log_scale[0::2] + log_scale[1::2] + np.log(scale)
+  return log_scale[0] + np.log(np.sum(prod[0, :, 0], axis=-1))
+
+
+def max_plus_product(a, b):
+  """The matrix product in the max-plus semiring, max_j a[i, j] + b[j, k],
+     for arrays of shape (..., states, states).
+  """
+  num_states = a.shape[-1]
+  out = a[..., :, 0:1] + b[..., 0:1, :]
+  for j in range(1, num_states):
+    np.maximum(out, a[..., :, j:j + 1] + b[..., j:j + 1, :], out=out)
+  return out
+
+
+def prefix_scan(ops, combine):
+  """The inclusive scan of ops along the first axis with an associative
+     combine, in O(log N) sequential steps and O(N) combines.
+
+  Args:
+    ops: A numpy array of shape (N, ...).
+    combine: An associative function of two arrays of shape (M, ...).
+
+  Returns:
+    A numpy array out of shape (N, ...), with out[n] the combination of
+    ops[0], ..., ops[n] in order.
+  """
+  length = ops.shape[0]
+  if length == 1:
+    return ops
+  # the scan of the pairs gives the odd prefixes, which extend to the even
+  out = np.empty(ops.shape, dtype=ops.dtype)
+  out[1::2] = prefix_scan(combine(ops[0:length - 1:2], ops[1::2]), combine)
+  out[0::2] = np.concatenate(
+    [ops[:1], combine(out[1:length - 1:2], ops[2::2])])
+  return out
+
+
+def posterior(data, p0, tp, mu, sigma, mask=None, covariance_type='full',
+              banded=False, factors=None, scan=False):
+  """Calculates the log-scale posterior probability of each time serie.
+
+  Args:
+    data: A numpy array of shape (I, N, dim).
+    p0, tp, mu, sigma: The model parameters.
+    mask: None or a (I, N) array with zeros on the padded frames.
+    covariance_type: The covariance type of sigma.
+    banded: If True, tp is a left-to-right or cyclic transition matrix.
+    factors: None or the output of gaussian_factors(sigma, ...).
+    scan: If True, the forward operators are multiplied in a balanced
+      tree, in O(log N) sequential steps but O(states^3) per frame.
+
+  Returns:
+    A numpy array of shape (I,).
+  """
+  em, shift = scaled_emissions(
+    masked_log_emissions(data, mu, sigma, mask, covariance_type, factors))
+  # the log-likelihoods are summed in float64
+  if scan:
+    log_c = product_log_likelihood(forward_operators(em, p0, tp, mask))
+  else:
+    _, c = forward(em, p0, tp, mask, banded)
+    log_c = np.sum(np.log(c), axis=0, dtype=np.float64)
+  return log_c + np.sum(shift, axis=-1, dtype=np.float64)
+
+
+def viterbi(data, p0, tp, mu, sigma, mask=None, covariance_type='full',
+            banded=False, factors=None, scan=False):
+  """Runs the viterbi recursion in log-scale.
+
+  Args:
+    data: A numpy array of shape (I, N, dim).
+    p0, tp, mu, sigma: The model parameters.
+    mask: None or a (I, N) array with zeros on the padded frames, where
+      the scores stay unchanged and the back pointers point to the same state.
+    covariance_type: The covariance type of sigma.
+    banded: If True, tp is a left-to-right or cyclic transition matrix and
+      every step compares only the previous and the same state.
+    factors: None or the output of gaussian_factors(sigma, ...).
+    scan: If True, the path scores are a prefix scan of the per-frame
+      operators in the max-plus semiring, in O(log N) sequential steps but
+      O(states^3) per frame.
+
+  Returns:
+    The path scores w and the back pointers am, both of shape (I, N, states).
+  """
+  # the path scores are sums over all the frames, they are accumulated in
+  # float64 whatever the dtype of the data
+  log_em = masked_log_emissions(
+    data, mu, sigma, mask, covariance_type, factors).astype(np.float64)
+  num_seq, length, num_states = log_em.shape
+  with np.errstate(divide='ignore'):
+    log_tp = np.log(np.asarray(tp, dtype=np.float64))
+    log_p0 = np.log(np.reshape(p0, (-1,)).astype(np.float64))
+  if scan:
+    return _viterbi_scan(log_em, log_p0, log_tp, mask, banded)
+  w = np.empty((num_seq, length, num_states))
+  am = np.zeros((num_seq, length, num_states), dtype=np.int64)
+  if banded:
+    log_stay, log_move = transition_band(log_tp)
+    states = np.arange(num_states)
+    prev_states = (states - 1) % num_states
+  w[:, 0] = log_p0 + log_em[:, 0]
+  for n in range(1, length):
+    if banded:
+      w_stay = w[:, n - 1] + log_stay
+      w_move = np.roll(w[:, n - 1] + log_move, 1, axis=-1)
+      # ties go to the lowest state index, as with the dense argmax
+      take_move = (w_move > w_stay) | ((w_move == w_stay) & (states > 0))
+      am[:, n] = np.where(take_move, prev_states, states)
+      w[:, n] = log_em[:, n] + np.where(take_move, w_move, w_stay)
+    else:
+      w_tp = w[:, n - 1, :, None] + log_tp
+      am[:, n] = np.argmax(w_tp, axis=-2)
+      w[:, n] = log_em[:, n] + np.max(w_tp, axis=-2)
+    if mask is not None:
+      valid = mask[:, n, None] > 0
+      am[:, n] = np.where(valid, am[:, n], np.arange(num_states))
+      w[:, n] = np.where(valid, w[:, n], w[:, n - 1])
+  return w, am
+
+
+def _viterbi_scan(log_em, log_p0, log_tp, mask, banded):
+  # the max-plus analogue of forward_operators, with the max-plus identity,
+  # zero on the diagonal and -inf elsewhere, on the padded frames
+  num_seq, length, num_states = log_em.shape
+  ops = log_tp + np.transpose(log_em, (1, 0, 2))[:, :, None, :]
+  ops[0] = np.expand_dims(log_p0 + log_em[:, 0], -2)
+  if mask is not None:
+    with np.errstate(divide='ignore'):
+      ops[np.transpose(mask) == 0] = np.log(np.identity(num_states))
+  w = np.transpose(prefix_scan(ops, max_plus_product)[:, :, 0], (1, 0, 2))
+  # the back pointers of all the frames at once, from the previous scores
+  am = np.zeros((num_seq, length, num_states), dtype=np.int64)
+  states = np.arange(num_states)
+  if banded:
+    log_stay, log_move = transition_band(log_tp)
+    w_stay = w[:, :-1] + log_stay
+    w_move = np.roll(w[:, :-1] + log_move, 1, axis=-1)
+    # ties go to the lowest state index, as with the dense argmax
+    take_move = (w_move > w_stay) | ((w_move == w_stay) & (states > 0))
+    am[:, 1:] = np.where(take_move, (states - 1) % num_states, states)
+  else:
+    am[:, 1:] = np.argmax(w[:, :-1, :, None] + log_tp, axis=-2)
+  if mask is not None:
+    am[:, 1:] = np.where(mask[:, 1:, None] > 0, am[:, 1:], states)
+  return w, am
+
+
+def sample(num_samples, p0, tp, mu, sigma, random_state=None,
+           covariance_type='full', num_sequences=None, factors=None):
+  """Generates sequences of observations from the model.
+
+  The Markov chains of all the sequences advance together, one frame at a
+  time, and the emissions of the visited states are drawn at once from
+  pre-drawn standard normals and the Cholesky factors of the states.
+
+  Args:
+    num_samples: The number of samples of each generated sequence.
+    p0, tp, mu, sigma: The model parameters.
+    random_state: None or a numpy RandomState.
+    covariance_type: The covariance type of sigma.
+    num_sequences: None for a single sequence, or the number of sequences.
+    factors: None or the output of gaussian_factors(sigma, ...).
+
+  Returns:
+    The observations, shape (num_samples, dim) and the hidden states,
+    shape (num_samples, 1), or shapes (num_sequences, num_samples, dim)
+    and (num_sequences, num_samples) if num_sequences is given.
+  """
+  rng = np.random if random_state is None else random_state
+  num_states, data_dim = mu.shape
+  num_seq = 1 if num_sequences is None else num_sequences
+  cum_p0 = np.cumsum(np.reshape(p0, (-1,)))
+  cum_tp = np.cumsum(tp, axis=1)
+  rand = rng.uniform(size=(num_seq, num_samples))
+  # the first state whose cumulative probability exceeds the uniform draw
+  states = np.empty((num_seq, num_samples), dtype=np.int64)
+  states[:, 0] = np.sum(cum_p0 <= rand[:, 0, None], axis=-1)
+  for n in range(1, num_samples):
+    states[:, n] = np.sum(cum_tp[states[:, n - 1]] <= rand[:, n, None], axis=-1)
+  # guards against cumulative probabilities that round below one
+  np.minimum(states, num_states - 1, out=states)
+  z = rng.standard_normal(size=(num_seq, num_samples, data_dim))
+  if factors is None:
+    factors = gaussian_factors(sigma, covariance_type, data_dim)
+  scale = factors[0]
+  if scale.ndim == 2:
+    # standard deviations of diagonal or spherical covariances
+    samples = mu[states] + scale[states] * z
+  else:
+    # the tied factor is shared by all the states
+    chol = np.broadcast_to(scale, (num_states,) + scale.shape[1:])
+    samples = np.empty(z.shape)
+    for k in range(num_states):
+      visited = states == k
+      samples[visited] = mu[k] + np.dot(z[visited], chol[k].T)
+  if num_sequences is None:
+    return samples[0], states[0, :, None]
+  return samples, states
@@ -0,0 +1,198 @@
+"""Online filtering of live observation streams with the HMM class.
+
+An OnlineFilter holds the forward state of a batch of streams, e.g. one
+stream per device, and advances all of them in one vectorized step per
+frame. Streams without a new frame are skipped through an active mask, and
+every stream can be restarted on its own. The last frames that the fixed-lag
+smoother and the online viterbi decoder look back at are kept in ring
+buffers, so a frame costs the same whatever the length of the streams.
+"""
+import numpy as np
+from . import numpy_backend
+
+
+class OnlineFilter(object):
+  """A stateful forward filter of a batch of live observation streams.
+
+  The filter advances the active streams of the batch together, one frame
+  or a small chunk of frames at a time. Every frame costs O(states^2) per
+  stream, independently of the length of the stream so far. It is usually
+  created by HMM.online_filter.
+  """
+
+  def __init__(self, p0, tp, mu, sigma, num_streams=1, lag=0,
+               viterbi_window=None, covariance_type='full', factors=None):
+    """Init method of the OnlineFilter class.
+
+    Args:
+      p0, tp, mu, sigma: The parameters of the model.
+      num_streams: Number of streams that are filtered in parallel.
+      lag: The lag of the fixed-lag smoothed estimates, 0 disables them.
+      viterbi_window: None or the length of the traceback window of the
+        online viterbi decoder.
+      covariance_type: The covariance type of sigma.
+      factors: None or the output of numpy_backend.gaussian_factors(sigma,
+        ...), computed from sigma if None.
+    """
+    self._p0 = np.reshape(p0, (-1,))
+    self._tp = tp
+    self._mu = mu
+    if factors is None:
+      factors = numpy_backend.gaussian_factors(
+        sigma, covariance_type, np.shape(mu)[-1])
+    self._factors = factors
+    self._num_states = self._p0.shape[0]
+    self._num_streams = num_streams
+    self._lag = lag
+    self._viterbi_window = viterbi_window
+    with np.errstate(divide='ignore'):
+      self._log_p0 = np.log(self._p0)
+      self._log_tp = np.log(tp)
+    shape = (num_streams, self._num_states)
+    self._rows = np.arange(num_streams)
+    self._num_frames = np.zeros((num_streams,), dtype=np.int64)
+    self._alpha = np.zeros(shape)
+    self._log_likelihood = np.zeros((num_streams,))
+    # ring buffers of the filtered estimates and the emissions of the last
+    # lag + 1 frames and of the back pointers of the last viterbi_window
+    # frames, the frame n of a stream is in the slot n % size
+    self._alpha_buffer = np.zeros((lag + 1,) + shape)
+    self._em_buffer = np.zeros((lag + 1,) + shape)
+    if viterbi_window is not None:
+      self._delta = np.zeros(shape)
+      self._am_buffer = np.zeros((viterbi_window,) + shape, dtype=np.int64)
+    self._smoothed = np.zeros((num_streams, 0, self._num_states))
+    self._decoded = np.zeros((num_streams, 0), dtype=np.int64)
+
+  def reset(self, streams=None):
+    """Restarts streams.
+
+    Args:
+      streams: None for all the streams, or the indices or a boolean mask
+        of the streams to restart.
+    """
+    if streams is None:
+      streams = slice(None)
+    self._num_frames[streams] = 0
+    self._alpha[streams] = 0.0
+    self._log_likelihood[streams] = 0.0
+    if self._viterbi_window is not None:
+      self._delta[streams] = 0.0
+
+  def update(self, x, active=None):
+    """Advances the streams by one frame or a chunk of frames.
+
+    Args:
+      x: A numpy array of shape (streams, dim) for one frame per stream, or
+        of shape (streams, frames, dim) for a chunk.
+      active: None if every stream has every frame, or a boolean mask of
+        shape (streams,), or (streams, frames) for a chunk, with False on
+        the frames a stream does not have. The state of a stream is left
+        unchanged by its inactive frames, whose values are ignored.
+
+    Returns:
+      The filtered state probabilities after every frame, with shape
+      (streams, states), or (streams, frames, states) for a chunk.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    chunk = x.ndim == 3
+    if not chunk:
+      x = np.expand_dims(x, 1)
+    num_frames = x.shape[1]
+    if active is None:
+      active = np.ones(x.shape[:2], dtype=bool)
+    else:
+      active = np.reshape(np.asarray(active, dtype=bool), x.shape[:2])
+      x = np.where(active[..., None], x, 0.0)
+    log_em = numpy_backend.log_emissions(x, self._mu, None, self._factors)
+    filtered = np.empty(log_em.shape)
+    self._smoothed = np.full(log_em.shape, np.nan)
+    self._decoded = np.full(x.shape[:2], -1, dtype=np.int64)
+    for n in range(num_frames):
+      filtered[:, n] = self._step(log_em[:, n], active[:, n], n)
+    return filtered if chunk else filtered[:, 0]
+
+  @property
+  def num_frames(self):
+    """The number of frames of each stream so far, shape (streams,)."""
+    return self._num_frames
+
+  @property
+  def filtered(self):
+    """The current filtered state probabilities, shape (streams, states)."""
+    return self._alpha
+
+  @property
+  def log_likelihood(self):
+    """The log-likelihood of each stream so far, shape (streams,)."""
+    return self._log_likelihood
+
+  @property
+  def smoothed(self):
+    """The fixed-lag smoothed state probabilities produced by the frames of
+       the last update, shape (streams, frames, states). The estimate of a
+       frame is produced lag frames after the frame itself, the entries of
+       the frames that produced none are NaN.
+    """
+    return self._smoothed
+
+  @property
+  def decoded(self):
+    """The states decided by the online viterbi decoder at the frames of
+       the last update, shape (streams, frames). The decision for a frame
+       is made viterbi_window - 1 frames after the frame itself, the
+       entries of the frames that made none are -1.
+    """
+    return self._decoded
+
+  def _step(self, log_em, active, n):
+    # the frame t of every stream, only the active streams change
+    t = self._num_frames
+    start = t == 0
+    em, shift = numpy_backend.scaled_emissions(log_em)
+    a_n = em * np.where(
+      start[:, None], self._p0, np.dot(self._alpha, self._tp))
+    c_n = np.sum(a_n, axis=-1)
+    rows = self._rows[active]
+    t_active = t[active]
+    self._alpha[rows] = a_n[rows] / c_n[rows, None]
+    self._log_likelihood[rows] += np.log(c_n[rows]) + shift[rows]
+    if self._lag > 0:
+      slots = t_active % (self._lag + 1)
+      self._alpha_buffer[slots, rows] = self._alpha[rows]
+      self._em_buffer[slots, rows] = em[rows]
+      ready = t_active >= self._lag
+      self._smoothed[rows[ready], n] = self._smooth(
+        rows[ready], t_active[ready])
+    if self._viterbi_window is not None:
+      w_tp = self._delta[rows, :, None] + self._log_tp
+      delta = np.where(start[rows, None], self._log_p0 + log_em[rows],
+                       log_em[rows] + np.max(w_tp, axis=-2))
+      self._am_buffer[t_active % self._viterbi_window, rows] = np.argmax(
+        w_tp, axis=-2)
+      # keeps the scores bounded on endless streams
+      self._delta[rows] = delta - np.max(delta, axis=-1, keepdims=True)
+      ready = t_active >= self._viterbi_window - 1
+      self._decoded[rows[ready], n] = self._traceback(
+        rows[ready], t_active[ready])
+    self._num_frames[rows] += 1
+    return self._alpha
+
+  def _smooth(self, rows, t):
+    # backward recursion over the frames t - lag + 1, ..., t of the streams
+    # rows, normalized at each step
+    betta = np.ones((len(rows), self._num_states))
+    for j in range(self._lag, 0, -1):
+      em = self._em_buffer[(t - self._lag + j) % (self._lag + 1), rows]
+      betta = np.dot(betta * em, self._tp.T)
+      betta /= np.sum(betta, axis=-1, keepdims=True)
+    gamma = self._alpha_buffer[(t - self._lag) % (self._lag + 1), rows] * betta
+    return gamma / np.sum(gamma, axis=-1, keepdims=True)
+
+  def _traceback(self, rows, t):
+    # the state of the frame t - viterbi_window + 1 of the streams rows
+    state = np.argmax(self._delta[rows], axis=-1)
+    for j in range(self._viterbi_window - 1, 0, -1):
+      slots = (t - self._viterbi_window + 1 + j) % self._viterbi_window
+      state = self._am_buffer[slots, rows, state]
+    return state
@@ -0,0 +1,401 @@
+"""Sequence sources for the out-of-core training of the HMM class.
+
+A source yields the training sequences chunk by chunk, so that the graph
+never has to hold the whole dataset. The supported inputs are numpy arrays
+(including memory-mapped arrays), lists of variable-length sequences, lists
+of paths to .npy shards and callables that return a fresh iterator of
+sequence chunks at every call.
+
+Every chunk is a pair (batch, mask) of a rank three array and either None,
+when all the sequences of the batch have the same length, or a (I, N) mask
+with ones on the frames of the sequences and zeros on their padding.
+"""
+import functools
+import types
+import numpy as np
+
+# default number of sequences per bucket of variable-length sequences
+BUCKET_SIZE = 64
+
+
+def as_source(data, lengths=None):
+  """Wraps the training data into a sequence source.
+
+  Args:
+    data: A numpy array with rank two or three (possibly a np.memmap),
+      a list of rank two arrays of variable lengths, a rank two array of
+      concatenated sequences together with their lengths, a path or a list
+      of paths to .npy files with rank two or three arrays, or a callable
+      that returns an iterator of chunks of any of the previous kinds.
+    lengths: None or the lengths of the concatenated sequences in data.
+
+  Returns:
+    An ArraySource, RaggedSource, ShardSource or StreamSource.
+  """
+  if isinstance(data, (ArraySource, RaggedSource, ShardSource, StreamSource)):
+    return data
+  if lengths is not None:
+    return RaggedSource(split_sequences(data, lengths))
+  if isinstance(data, str):
+    return ShardSource([data])
+  if isinstance(data, (list, tuple)) and data and isinstance(data[0], str):
+    return ShardSource(data)
+  if isinstance(data, (list, tuple)):
+    return RaggedSource(split_sequences(data))
+  if isinstance(data, types.GeneratorType):
+    raise ValueError('the training takes several passes over the data, '
+                     'pass a callable that returns a new generator instead')
+  if callable(data):
+    return StreamSource(data)
+  return ArraySource(data)
+
+
+def split_sequences(data, lengths=None):
+  """Splits the data into a list of rank two sequences.
+
+  Args:
+    data: A list of rank two arrays, or a rank two array of concatenated
+      sequences.
+    lengths: None or the lengths of the concatenated sequences in data.
+
+  Returns:
+    A list of rank two numpy arrays.
+  """
+  if lengths is None:
+    return [np.asarray(x, dtype=np.float64) for x in data]
+  data = np.asarray(data, dtype=np.float64)
+  ends = np.cumsum(lengths)
+  if ends[-1] != data.shape[0]:
+    raise ValueError('the lengths must sum up to the number of frames')
+  return np.split(data, ends[:-1])
+
+
+def pad_sequences(sequences):
+  """Pads a list of rank two sequences into a batch.
+
+  Args:
+    sequences: A list of rank two numpy arrays.
+
+  Returns:
+    The padded batch of shape (I, N, dim) and the mask of shape (I, N),
+    or None if all the sequences have the same length.
+  """
+  lengths = np.array([x.shape[0] for x in sequences])
+  batch = np.zeros((len(sequences), np.max(lengths), sequences[0].shape[-1]))
+  mask = np.zeros(batch.shape[:2])
+  for i, x in enumerate(sequences):
+    batch[i, :lengths[i]] = x
+    mask[i, :lengths[i]] = 1.0
+  if np.all(lengths == lengths[0]):
+    mask = None
+  return batch, mask
+
+
+def unpad_sequences(batch, mask):
+  """Inverse of pad_sequences, returns a list of rank two sequences."""
+  if mask is None:
+    return list(batch)
+  return [x[:int(np.sum(m))] for x, m in zip(batch, mask)]
+
+
+def buckets(sequences, bucket_size=None, shuffle=False):
+  """Groups sequences of similar lengths into padded batches.
+
+  Args:
+    sequences: A list of rank two numpy arrays.
+    bucket_size: None or the maximum number of sequences per bucket.
+    shuffle: Whether the buckets come in a random order (np.random)
+      instead of in increasing length.
+
+  Yields:
+    The indices of the sequences of a bucket, the padded batch and its mask.
+  """
+  order = np.argsort([x.shape[0] for x in sequences], kind='stable')
+  size = bucket_size or BUCKET_SIZE
+  for i in _chunk_starts(len(order), size, shuffle):
+    idx = order[i:i + size]
+    batch, mask = pad_sequences([sequences[j] for j in idx])
+    yield idx, batch, mask
+
+
+def sample_frames(source, num_frames, chunk_size=None):
+  """Draws a uniform random sample of frames in a single pass over a source.
+
+  Every frame gets a random key and the frames with the smallest keys are
+  kept (reservoir sampling), so the memory is bounded by num_frames and the
+  chunk size, whatever the size of the data.
+
+  Args:
+    source: A sequence source, see as_source.
+    num_frames: The maximum number of sampled frames.
+    chunk_size: None or the maximum number of sequences per chunk.
+
+  Returns:
+    The sampled frames, shape (frames, dim), and their relative positions
+    in their sequences, in [0, 1), shape (frames,).
+  """
+  frames = None
+  sample_keys = None
+  for batch, mask in source.chunks(chunk_size):
+    num_seq, length = batch.shape[:2]
+    if mask is None:
+      mask = np.ones((num_seq, length))
+    keys = np.random.rand(num_seq, length)
+    selected = mask > 0
+    if sample_keys is not None and len(sample_keys) == num_frames:
+      # only the frames that enter the reservoir are copied
+      selected &= keys < np.max(sample_keys)
+    positions = (np.arange(length) + 0.5) / np.sum(mask, axis=1, keepdims=True)
+    if sample_keys is None:
+      frames = batch[selected]
+      sample_positions = positions[selected]
+      sample_keys = keys[selected]
+    else:
+      frames = np.concatenate([frames, batch[selected]])
+      sample_positions = np.concatenate([sample_positions, positions[selected]])
+      sample_keys = np.concatenate([sample_keys, keys[selected]])
+    if len(sample_keys) > num_frames:
+      keep = np.argpartition(sample_keys, num_frames - 1)[:num_frames]
+      frames = frames[keep]
+      sample_positions = sample_positions[keep]
+      sample_keys = sample_keys[keep]
+  if frames is None or len(frames) == 0:
+    raise ValueError('the data has no frames')
+  return frames, sample_positions
+
+
+def _shard_bounds(num_sequences, index, count):
+  # the contiguous range of the sequences of shard index out of count
+  bounds = np.linspace(0, num_sequences, count + 1).astype(np.int64)
+  return bounds[index], bounds[index + 1]
+
+
+def _every_nth_chunk(factory, index, count):
+  # the chunks index, index + count, ... of a pass over a stream
+  for i, chunk in enumerate(factory()):
+    if i % count == index:
+      yield chunk
+
+
+def _chunk_starts(num_sequences, size, shuffle):
+  # the first sequences of the chunks of size sequences, in a random order
+  # with shuffle
+  starts = np.arange(0, num_sequences, size)
+  if shuffle:
+    starts = np.random.permutation(starts)
+  return starts
+
+
+def _as_rank_three(data):
+  if data.ndim == 2:
+    return data[np.newaxis]
+  return data
+
+
+class ArraySource(object):
+  """A source over a numpy array or a memory-mapped array."""
+
+  def __init__(self, data):
+    if not isinstance(data, np.ndarray):
+      data = np.asarray(data, dtype=np.float64)
+    self._data = _as_rank_three(data)
+
+  @property
+  def num_sequences(self):
+    return self._data.shape[0]
+
+  def chunks(self, chunk_size=None, shuffle=False):
+    """Yields the sequences in chunks of at most chunk_size sequences, in
+       a random order of the chunks with shuffle.
+    """
+    size = chunk_size or max(self.num_sequences, 1)
+    for i in _chunk_starts(self.num_sequences, size, shuffle):
+      yield np.asarray(self._data[i:i + size], dtype=np.float64), None
+
+  def get_batch(self, batch_size):
+    """Returns batch_size randomly chosen sequences."""
+    idx = np.random.choice(self.num_sequences, batch_size, replace=False)
+    return np.asarray(self._data[idx], dtype=np.float64), None
+
+  def shard(self, index, count):
+    """Returns the source of the shard index of count contiguous shards."""
+    start, stop = _shard_bounds(self.num_sequences, index, count)
+    return ArraySource(self._data[start:stop])
+
+  def __getstate__(self):
+    # a memory-mapped array is sent to other processes by reference
+    data = self._data
+    if isinstance(data, np.memmap) and data.filename is not None:
+      return {'memmap': (data.filename, data.dtype, data.shape, data.offset,
+                         'F' if np.isfortran(data) else 'C')}
+    return {'data': data}
+
+  def __setstate__(self, state):
+    if 'memmap' in state:
+      filename, dtype, shape, offset, order = state['memmap']
+      self._data = np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                             offset=offset, order=order)
+    else:
+      self._data = state['data']
+
+
+class RaggedSource(object):
+  """A source over a list of sequences of variable lengths, which are
+     bucketed by length into padded batches.
+  """
+
+  def __init__(self, sequences):
+    self._sequences = sequences
+
+  @property
+  def num_sequences(self):
+    return len(self._sequences)
+
+  def chunks(self, chunk_size=None, shuffle=False):
+    """Yields buckets of at most chunk_size (or BUCKET_SIZE) sequences of
+       similar lengths, in a random order of the buckets with shuffle.
+    """
+    for _, batch, mask in buckets(self._sequences, chunk_size, shuffle):
+      yield batch, mask
+
+  def get_batch(self, batch_size):
+    """Returns batch_size randomly chosen sequences."""
+    idx = np.random.choice(self.num_sequences, batch_size, replace=False)
+    return pad_sequences([self._sequences[i] for i in idx])
+
+  def shard(self, index, count):
+    """Returns the source of the shard index of count contiguous shards."""
+    start, stop = _shard_bounds(self.num_sequences, index, count)
+    return RaggedSource(self._sequences[start:stop])
+
+
+class ShardSource(object):
+  """A source over .npy shards, which are memory-mapped when read."""
+
+  def __init__(self, paths, bounds=None):
+    # bounds, if given, limits every file to a range of its sequences
+    self._paths = list(paths)
+    self._bounds = bounds
+    self._sizes = [_as_rank_three(self._open(s)).shape[0]
+                   for s in range(len(self._paths))]
+
+  @property
+  def num_sequences(self):
+    return sum(self._sizes)
+
+  def chunks(self, chunk_size=None, shuffle=False):
+    """Yields the sequences of every shard in chunks of at most chunk_size
+       sequences, in a random order of the chunks of all the shards with
+       shuffle. A chunk never spans two shards.
+    """
+    if not shuffle:
+      for s in range(len(self._paths)):
+        for chunk in ArraySource(self._open(s)).chunks(chunk_size):
+          yield chunk
+      return
+    pieces = [(s, start) for s, size in enumerate(self._sizes)
+              for start in _chunk_starts(size, chunk_size or max(size, 1),
+                                         False)]
+    for i in np.random.permutation(len(pieces)):
+      s, start = pieces[i]
+      data = _as_rank_three(self._open(s))
+      size = chunk_size or data.shape[0]
+      yield np.asarray(data[start:start + size], dtype=np.float64), None
+
+  def get_batch(self, batch_size):
+    """Returns batch_size randomly chosen sequences of all the shards."""
+    idx = np.sort(np.random.choice(
+      self.num_sequences, batch_size, replace=False))
+    offsets = np.cumsum([0] + self._sizes)
+    batch = []
+    for s in range(len(self._paths)):
+      local = idx[(idx >= offsets[s]) & (idx < offsets[s + 1])] - offsets[s]
+      if len(local) > 0:
+        batch.extend(np.asarray(
+          _as_rank_three(self._open(s))[local], dtype=np.float64))
+    return pad_sequences(batch)
+
+  def shard(self, index, count):
+    """Returns the source of the shard index of count shards, with every
+       count-th file, or with a contiguous part of every file if there are
+       fewer files than shards.
+    """
+    if len(self._paths) >= count and self._bounds is None:
+      return ShardSource(self._paths[index::count])
+    bounds = [_shard_bounds(size, index, count) for size in self._sizes]
+    if self._bounds is not None:
+      bounds = [(offset + start, offset + stop) for (offset, _), (start, stop)
+                in zip(self._bounds, bounds)]
+    return ShardSource(self._paths, bounds)
+
+  def _open(self, s):
+    # the memory-mapped file s, limited to its bounds
+    data = np.load(self._paths[s], mmap_mode='r')
+    if self._bounds is None:
+      return data
+    start, stop = self._bounds[s]
+    return _as_rank_three(data)[start:stop]
+
+
+class StreamSource(object):
+  """A source over a callable that returns an iterator of sequence chunks."""
+
+  def __init__(self, factory):
+    self._factory = factory
+    self._stream = None
+    self._pending = None
+
+  @property
+  def num_sequences(self):
+    # not known without a full pass over the stream
+    return None
+
+  def chunks(self, chunk_size=None, shuffle=False):
+    """Yields the chunks of a new pass, split in at most chunk_size
+       sequences. A stream always comes in its own order, whatever
+       shuffle.
+    """
+    for chunk in self._factory():
+      for sub_chunk in as_source(chunk).chunks(chunk_size):
+        yield sub_chunk
+
+  def get_batch(self, batch_size):
+    """Returns the next batch_size sequences of the stream, starting a new
+       pass whenever the stream is exhausted.
+    """
+    batch = []
+    num = 0
+    passes = 0
+    while num < batch_size:
+      if self._pending is None:
+        if self._stream is None:
+          if passes == 2:
+            # the whole stream is shorter than the batch
+            break
+          self._stream = self.chunks()
+          passes += 1
+        chunk = next(self._stream, None)
+        if chunk is None:
+          self._stream = None
+          continue
+        self._pending = unpad_sequences(*chunk)
+      batch.extend(self._pending[:batch_size - num])
+      self._pending = self._pending[batch_size - num:] or None
+      num = len(batch)
+    if not batch:
+      raise ValueError('the stream of sequences is empty')
+    return pad_sequences(batch)
+
+  def shard(self, index, count):
+    """Returns the source of every count-th chunk of the stream, starting
+       from the chunk index. Every shard still reads the whole stream.
+    """
+    return StreamSource(
+      functools.partial(_every_nth_chunk, self._factory, index, count))
+
+  def __getstate__(self):
+    # the factory must be picklable, the position in the stream is not kept
+    return {'factory': self._factory}
+
+  def __setstate__(self, state):
+    self.__init__(state['factory'])
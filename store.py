@@ -0,0 +1,181 @@
+"""The single-file model format of the HMM class and a cache of loaded models.
+
+A model file starts with a fixed preamble, the magic string, the format
+version and the length of a JSON header. The header holds the configuration
+of the model and the dtype, shape and offset of every array. The arrays
+follow, uncompressed and aligned to ALIGNMENT bytes, so a file can be
+memory-mapped read-only and its pages are shared by all the processes that
+load it. Besides the parameters, a file holds the factors of the
+covariances (see numpy_backend.gaussian_factors), so a loaded model scores
+without factorizing them again.
+"""
+import collections
+import json
+import os
+import struct
+import threading
+import numpy as np
+
+MAGIC = b'\x93KHMM'
+FORMAT_VERSION = 1
+# the arrays start at multiples of ALIGNMENT bytes
+ALIGNMENT = 64
+# the configuration every file header must hold
+CONFIG_KEYS = ('num_states', 'data_dim', 'hmm_type', 'covariance_type',
+               'recursion', 'dtype', 'epoch')
+
+_PREAMBLE = struct.Struct('<5sHI')
+
+
+def is_model_file(filename):
+  """Returns whether filename starts with the magic string of the format."""
+  with open(filename, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+
+def write_model(filename, config, arrays):
+  """Writes a model file.
+
+  Args:
+    filename: The path of the file.
+    config: A dict with the CONFIG_KEYS of the model, JSON serializable.
+    arrays: An ordered dict of the named numpy arrays of the model.
+  """
+  missing = [key for key in CONFIG_KEYS if key not in config]
+  if missing:
+    raise ValueError('the config misses ' + ', '.join(missing))
+  arrays = collections.OrderedDict(
+    (name, np.ascontiguousarray(value)) for name, value in arrays.items())
+  entries = []
+  offset = 0
+  for name, value in arrays.items():
+    entries.append({'name': name, 'dtype': value.dtype.str,
+                    'shape': list(value.shape), 'offset': offset})
+    offset = _aligned(offset + value.nbytes)
+  header = json.dumps(
+    {'config': config, 'arrays': entries}, sort_keys=True).encode('utf-8')
+  # the arrays start after the preamble and the header, padded to ALIGNMENT
+  start = _aligned(_PREAMBLE.size + len(header))
+  header += b' ' * (start - _PREAMBLE.size - len(header))
+  # written to a temporary file and renamed, so readers never see a
+  # partial file
+  tmp = filename + '.tmp' + str(os.getpid())
+  with open(tmp, 'wb') as f:
+    f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+    f.write(header)
+    for entry, value in zip(entries, arrays.values()):
+      f.seek(start + entry['offset'])
+      f.write(value.tobytes())
+  os.replace(tmp, filename)
+
+
+def read_model(filename, mmap=True):
+  """Reads a model file.
+
+  Args:
+    filename: The path of the file.
+    mmap: Whether the arrays are read-only views of a memory map of the
+      file, or read into memory.
+
+  Returns:
+    The config dict and an ordered dict of the named arrays of the model.
+  """
+  with open(filename, 'rb') as f:
+    preamble = f.read(_PREAMBLE.size)
+    if len(preamble) < _PREAMBLE.size or preamble[:len(MAGIC)] != MAGIC:
+      raise ValueError(filename + ' is not a model file')
+    _, version, header_len = _PREAMBLE.unpack(preamble)
+    if version > FORMAT_VERSION:
+      raise ValueError(filename + ' has format version ' + str(version) +
+                       ', newer than ' + str(FORMAT_VERSION))
+    header = json.loads(f.read(header_len).decode('utf-8'))
+  start = _PREAMBLE.size + header_len
+  if mmap:
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+  else:
+    buffer = np.fromfile(filename, dtype=np.uint8)
+  arrays = collections.OrderedDict()
+  for entry in header['arrays']:
+    arrays[entry['name']] = np.ndarray(
+      tuple(entry['shape']), dtype=np.dtype(entry['dtype']), buffer=buffer,
+      offset=start + entry['offset'])
+  return header['config'], arrays
+
+
+class ModelCache(object):
+  """A process-level LRU cache of loaded models.
+
+  The models are keyed by the real path, the modification time and the size
+  of their files, so a model is loaded again after its file is replaced.
+  The least recently used models are evicted once the arrays of the cached
+  models exceed max_bytes, but the most recent model is always kept.
+  """
+
+  def __init__(self, max_bytes=2 ** 30, max_models=None):
+    """Init method of the ModelCache class.
+
+    Args:
+      max_bytes: The bound on the bytes of the arrays of the cached models.
+      max_models: None or the bound on the number of cached models.
+    """
+    self.max_bytes = max_bytes
+    self.max_models = max_models
+    self._models = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._models)
+
+  @property
+  def nbytes(self):
+    """The bytes of the arrays of the cached models."""
+    return sum(nbytes for _, nbytes in self._models.values())
+
+  def get(self, filename, load, *args):
+    """Returns the cached model of a file, loaded by load if needed.
+
+    Args:
+      filename: The path of the model file.
+      load: A callable that loads the model, called as load(filename, *args)
+        and returning the model and the bytes of its arrays.
+      *args: Further arguments of load, part of the key of the model.
+
+    Returns:
+      The cached model, shared by all the callers.
+    """
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size) + tuple(args)
+    with self._lock:
+      if key in self._models:
+        self._models.move_to_end(key)
+        return self._models[key][0]
+    model, nbytes = load(path, *args)
+    with self._lock:
+      # the models of older versions of the file are dropped
+      for old in [old for old in self._models
+                  if old[0] == path and old[1:3] != key[1:3]]:
+        del self._models[old]
+      self._models[key] = (model, nbytes)
+      self._evict()
+    return model
+
+  def clear(self):
+    """Drops all the cached models."""
+    with self._lock:
+      self._models.clear()
+
+  def _evict(self):
+    # drops the least recently used models above the bounds
+    while len(self._models) > 1 and (
+        self.nbytes > self.max_bytes or
+        (self.max_models is not None and len(self._models) > self.max_models)):
+      self._models.popitem(last=False)
+
+
+# the cache of HMM.load
+MODEL_CACHE = ModelCache()
+
+
+def _aligned(offset):
+  return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from kesmarag.ml.hmm import HMM
+
+
+def random_params(num_states, data_dim, hmm_type, covariance_type, seed=0):
+  """Fixed-seed parameters of a model, with transitions in the support of
+     hmm_type and covariances in the form of covariance_type."""
+  rng = np.random.RandomState(seed)
+  support = HMM(num_states, data_dim, hmm_type, backend='numpy')._tp > 0
+  tp = support * rng.uniform(0.2, 1.0, (num_states, num_states))
+  tp /= np.sum(tp, axis=1, keepdims=True)
+  p0 = rng.dirichlet(np.ones(num_states))[np.newaxis]
+  mu = rng.randn(num_states, data_dim) * 2.0
+  if covariance_type == 'diag':
+    sigma = rng.uniform(0.5, 2.0, (num_states, data_dim))
+  elif covariance_type == 'spherical':
+    sigma = rng.uniform(0.5, 2.0, (num_states,))
+  else:
+    a = rng.randn(num_states, data_dim, data_dim)
+    sigma = np.matmul(a, np.transpose(a, (0, 2, 1))) + np.eye(data_dim)
+    if covariance_type == 'tied':
+      sigma = sigma[0]
+  return p0, tp, mu, sigma
+
+
+@pytest.fixture
+def make_model():
+  """A factory of models with the parameters of random_params."""
+  def make(num_states, data_dim, hmm_type='fully-connected',
+           covariance_type='full', seed=0, **kwargs):
+    model = HMM(num_states, data_dim, hmm_type,
+                covariance_type=covariance_type, **kwargs)
+    model._p0, model._tp, model._mu, model._sigma = random_params(
+      num_states, data_dim, hmm_type, covariance_type, seed)
+    model._epoch = 1
+    model._params_version += 1
+    return model
+  return make
@@ -0,0 +1,41 @@
+"""The banded recursions of the left-to-right and cyclic models against the
+dense recursions of a fully-connected model with the same transitions."""
+import numpy as np
+import pytest
+from kesmarag.ml.hmm import HMMBank
+
+
+def dense_copy(make_model, model, **kwargs):
+  dense = make_model(model._num_states, model._data_dim, **kwargs)
+  dense._p0, dense._tp = model._p0, model._tp
+  dense._mu, dense._sigma = model._mu, model._sigma
+  dense._params_version += 1
+  return dense
+
+
+@pytest.mark.parametrize('backend', ('tensorflow', 'numpy'))
+@pytest.mark.parametrize('hmm_type', ('left-to-right', 'cyclic'))
+@pytest.mark.parametrize('num_states', (1, 2, 4))
+def test_banded_matches_dense(make_model, num_states, hmm_type, backend):
+  data = np.random.RandomState(2).randn(3, 50, 2)
+  model = make_model(num_states, 2, hmm_type, backend=backend)
+  dense = dense_copy(make_model, model, backend=backend)
+  np.testing.assert_allclose(
+    model.posterior(data), dense.posterior(data), rtol=1e-10)
+  gamma, xi = model.predict_proba(data, return_transitions=True)
+  gamma_dense, xi_dense = dense.predict_proba(data, return_transitions=True)
+  np.testing.assert_allclose(gamma, gamma_dense, rtol=1e-9, atol=1e-12)
+  np.testing.assert_allclose(xi, xi_dense, rtol=1e-9, atol=1e-12)
+  np.testing.assert_array_equal(
+    model.run_viterbi(data), dense.run_viterbi(data))
+
+
+@pytest.mark.parametrize('num_states', (1, 3))
+def test_banded_bank_matches_dense(make_model, num_states):
+  data = np.random.RandomState(3).randn(2, 20, 2)
+  model = make_model(num_states, 2, 'cyclic', backend='numpy')
+  dense = dense_copy(make_model, model, backend='numpy')
+  np.testing.assert_allclose(
+    HMMBank([model]).score(data), HMMBank([dense]).score(data), rtol=1e-10)
+  np.testing.assert_allclose(
+    HMMBank([model]).score(data)[0], model.posterior(data), rtol=1e-10)
@@ -0,0 +1,74 @@
+"""Parity of the numpy backend with the tensorflow graph."""
+import subprocess
+import sys
+import numpy as np
+import pytest
+
+COVARIANCE_TYPES = ('full', 'diag', 'spherical', 'tied')
+HMM_TYPES = ('fully-connected', 'left-to-right', 'cyclic')
+# the tolerances of the probabilities and log-likelihoods of every dtype
+RTOL = {'float64': 1e-9, 'float32': 1e-4}
+ATOL = {'float64': 1e-12, 'float32': 1e-5}
+
+
+def ragged_data(seed=0, data_dim=3):
+  rng = np.random.RandomState(seed)
+  return [rng.randn(length, data_dim) * 2.0 for length in (9, 4, 1, 6)]
+
+
+def flat_paths(paths):
+  return np.concatenate([np.ravel(path) for path in paths])
+
+
+@pytest.mark.parametrize('dtype', ('float64', 'float32'))
+@pytest.mark.parametrize('covariance_type', COVARIANCE_TYPES)
+def test_dense_batch_parity(make_model, covariance_type, dtype):
+  data = np.random.RandomState(1).randn(3, 8, 3) * 2.0
+  models = [make_model(4, 3, covariance_type=covariance_type,
+                       backend=backend, dtype=dtype)
+            for backend in ('tensorflow', 'numpy')]
+  tf_model, np_model = models
+  np.testing.assert_allclose(
+    np_model.posterior(data), tf_model.posterior(data), rtol=RTOL[dtype])
+  gamma_np, xi_np = np_model.predict_proba(data, return_transitions=True)
+  gamma_tf, xi_tf = tf_model.predict_proba(data, return_transitions=True)
+  np.testing.assert_allclose(
+    gamma_np, gamma_tf, rtol=RTOL[dtype], atol=ATOL[dtype])
+  np.testing.assert_allclose(xi_np, xi_tf, rtol=RTOL[dtype], atol=ATOL[dtype])
+  np.testing.assert_array_equal(
+    np_model.run_viterbi(data), tf_model.run_viterbi(data))
+
+
+@pytest.mark.parametrize('dtype', ('float64', 'float32'))
+@pytest.mark.parametrize('hmm_type', HMM_TYPES)
+@pytest.mark.parametrize('covariance_type', COVARIANCE_TYPES)
+def test_masked_batch_parity(make_model, covariance_type, hmm_type, dtype):
+  # the variable-length sequences are padded and masked into one batch
+  data = ragged_data()
+  tf_model, np_model = [
+    make_model(4, 3, hmm_type, covariance_type, backend=backend, dtype=dtype)
+    for backend in ('tensorflow', 'numpy')]
+  np.testing.assert_allclose(
+    np_model.posterior(data), tf_model.posterior(data), rtol=RTOL[dtype])
+  np.testing.assert_allclose(
+    np_model.predict_proba(data), tf_model.predict_proba(data),
+    rtol=RTOL[dtype], atol=ATOL[dtype])
+  np.testing.assert_array_equal(
+    flat_paths(np_model.run_viterbi(data)),
+    flat_paths(tf_model.run_viterbi(data)))
+
+
+def test_numpy_backend_does_not_import_tensorflow():
+  # a fresh interpreter, where nothing has imported tensorflow yet
+  code = '\n'.join([
+    'import sys',
+    'import numpy as np',
+    'import kesmarag.ml.hmm',
+    'from kesmarag.ml.hmm import HMM',
+    'model = HMM(3, 2, backend="numpy")',
+    'model.posterior(np.random.randn(2, 5, 2))',
+    'model.run_viterbi(np.random.randn(2, 5, 2))',
+    'print(" ".join(name for name in ("tensorflow", "sklearn")',
+    '               if name in sys.modules))'])
+  out = subprocess.check_output([sys.executable, '-c', code])
+  assert out.decode().strip() == ''
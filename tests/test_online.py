@@ -0,0 +1,107 @@
+"""The online filter against the batch inference of the HMM class."""
+import numpy as np
+import pytest
+
+HMM_TYPES = ('fully-connected', 'left-to-right', 'cyclic')
+NUM_STREAMS = 3
+LENGTH = 30
+
+
+def streams(seed=0):
+  # well separated states, so that the online viterbi decisions settle
+  # within the window
+  rng = np.random.RandomState(seed)
+  return rng.randn(NUM_STREAMS, LENGTH, 2) * 3.0
+
+
+def run(online, data, chunk):
+  # the filtered estimates, smoothed estimates and decisions of all the
+  # frames, updated frame by frame or in chunks of chunk frames
+  filtered, smoothed, decoded = [], [], []
+  for n in range(0, data.shape[1], chunk or 1):
+    if chunk:
+      filtered.append(online.update(data[:, n:n + chunk]))
+    else:
+      filtered.append(online.update(data[:, n])[:, None])
+    smoothed.append(online.smoothed)
+    decoded.append(online.decoded)
+  return (np.concatenate(filtered, 1), np.concatenate(smoothed, 1),
+          np.concatenate(decoded, 1))
+
+
+@pytest.mark.parametrize('chunk', (None, 7))
+@pytest.mark.parametrize('hmm_type', HMM_TYPES)
+def test_online_matches_batch(make_model, hmm_type, chunk):
+  data = streams()
+  model = make_model(3, 2, hmm_type, backend='numpy')
+  lag, window = 3, 12
+  online = model.online_filter(NUM_STREAMS, lag=lag, viterbi_window=window)
+  filtered, smoothed, decoded = run(online, data, chunk)
+  np.testing.assert_allclose(
+    online.log_likelihood, model.posterior(data), rtol=1e-12)
+  np.testing.assert_array_equal(online.num_frames, LENGTH)
+  # the smoothed estimate produced at frame t is the posterior of the frame
+  # t - lag given the frames up to t
+  assert np.all(np.isnan(smoothed[:, :lag]))
+  for t in (lag, 11, LENGTH - 1):
+    gamma = model.predict_proba(data[:, :t + 1])
+    np.testing.assert_allclose(
+      smoothed[:, t], gamma[:, t - lag], rtol=1e-10, atol=1e-14)
+    # the last frame has no future, its posterior is the filtered estimate
+    np.testing.assert_allclose(
+      filtered[:, t], gamma[:, t], rtol=1e-10, atol=1e-14)
+  # the decision made at frame t is the one of the frame t - window + 1
+  assert np.all(decoded[:, :window - 1] == -1)
+  np.testing.assert_array_equal(
+    decoded[:, window - 1:], model.run_viterbi(data)[:, :LENGTH - window + 1])
+
+
+def test_filtered_estimates_of_a_cyclic_model(make_model):
+  data = streams(1)
+  model = make_model(4, 2, 'cyclic', backend='numpy')
+  online = model.online_filter(NUM_STREAMS)
+  for t in range(LENGTH):
+    filtered = online.update(data[:, t])
+    np.testing.assert_allclose(
+      filtered, model.predict_proba(data[:, :t + 1])[:, t], rtol=1e-10,
+      atol=1e-14)
+
+
+def test_inactive_frames_are_skipped(make_model):
+  data = streams(2)
+  model = make_model(3, 2, backend='numpy')
+  rng = np.random.RandomState(3)
+  active = rng.rand(NUM_STREAMS, LENGTH) < 0.6
+  online = model.online_filter(NUM_STREAMS, lag=2, viterbi_window=4)
+  online.update(np.where(active[..., None], data, np.nan), active=active)
+  np.testing.assert_array_equal(online.num_frames, np.sum(active, axis=1))
+  for i in range(NUM_STREAMS):
+    # every stream sees only its own active frames
+    frames = data[i, active[i]]
+    alone = model.online_filter(1, lag=2, viterbi_window=4)
+    alone.update(frames[None])
+    np.testing.assert_allclose(
+      online.log_likelihood[i], model.posterior(frames), rtol=1e-12)
+    np.testing.assert_allclose(
+      online.smoothed[i, active[i]], alone.smoothed[0], rtol=1e-12)
+    np.testing.assert_array_equal(
+      online.decoded[i, active[i]], alone.decoded[0])
+    assert np.all(online.decoded[i, ~active[i]] == -1)
+
+
+def test_reset_restarts_only_the_given_streams(make_model):
+  data = streams(4)
+  model = make_model(3, 2, 'left-to-right', backend='numpy')
+  online = model.online_filter(NUM_STREAMS, lag=1, viterbi_window=3)
+  online.update(data[:, :10])
+  online.reset([1])
+  online.update(data[:, 10:])
+  np.testing.assert_array_equal(online.num_frames, [LENGTH, LENGTH - 10,
+                                                   LENGTH])
+  np.testing.assert_allclose(
+    online.log_likelihood, [model.posterior(data[0]),
+                            model.posterior(data[1, 10:]),
+                            model.posterior(data[2])], rtol=1e-12)
+  online.reset()
+  np.testing.assert_array_equal(online.num_frames, 0)
+  np.testing.assert_array_equal(online.log_likelihood, 0.0)
@@ -0,0 +1,24 @@
+"""The training realizations of fit in parallel worker processes."""
+import numpy as np
+from kesmarag.ml.hmm import HMM
+
+
+def test_parallel_runs_match_serial_runs():
+  rng = np.random.RandomState(0)
+  data = rng.randn(12, 30, 2) + 4.0 * rng.randint(0, 3, (12, 30, 1))
+  models = []
+  for n_jobs in (1, 2):
+    model = HMM(3, 2)
+    model.fit(data, max_steps=5, num_runs=3, n_jobs=n_jobs, seed=11)
+    models.append(model)
+  serial, parallel = models
+  assert parallel.history['best_run'] == serial.history['best_run']
+  for run, expected in zip(parallel.history['runs'],
+                           serial.history['runs']):
+    assert run['seed'] == expected['seed']
+    np.testing.assert_allclose(
+      run['log_likelihood'], expected['log_likelihood'], rtol=1e-12)
+  for name in ('p0', 'tp', 'mu', 'sigma'):
+    np.testing.assert_allclose(
+      getattr(parallel, name), getattr(serial, name), rtol=1e-10,
+      atol=1e-12)
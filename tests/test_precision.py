@@ -0,0 +1,25 @@
+"""The single precision inference of the tensorflow graph."""
+import numpy as np
+import pytest
+
+COVARIANCE_TYPES = ('full', 'diag', 'spherical', 'tied')
+
+
+@pytest.mark.parametrize('covariance_type', COVARIANCE_TYPES)
+def test_float32_statistics_are_accumulated_in_float64(make_model,
+                                                       covariance_type):
+  data = np.random.RandomState(2).randn(40, 250, 3) * 2.0 + 10.0
+  models = [make_model(3, 3, covariance_type=covariance_type, dtype=dtype)
+            for dtype in ('float64', 'float32')]
+  stats = [model._run(model._stats, model._data_feed(data, None))
+           for model in models]
+  for key, expected in stats[0].items():
+    value = stats[1][key]
+    assert value.dtype == np.float64
+    np.testing.assert_allclose(value, expected, rtol=1e-4,
+                               atol=1e-6 * np.max(np.abs(expected)))
+  # the contractions over the frames run in float64, not only their results
+  sums = [op for op in models[1]._graph.get_operations()
+          if 'statistics/' in op.name and op.type in ('MatMul', 'Sum')]
+  assert sums
+  assert all(op.outputs[0].dtype.name == 'float64' for op in sums)
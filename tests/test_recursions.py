@@ -0,0 +1,87 @@
+"""Regression tests of the forward, backward, xi and viterbi recursions.
+
+The references in data/baseline_recursions.npz are the outputs of the
+tf.concat recursions of the original graph (commit 7bafd06) on the inputs
+below. The emissions of the current graph are shifted by their maximum over
+the states, which cancels out everywhere but in the scales c, so log(c) is
+compared after the shift is added back.
+"""
+import os
+import numpy as np
+import pytest
+from kesmarag.ml.hmm import HMM
+
+HMM_TYPES = ('fully-connected', 'left-to-right', 'cyclic')
+NUM_STATES = 3
+DATA_DIM = 2
+NUM_SEQUENCES = 2
+LENGTH = 7
+
+BASELINE = os.path.join(
+  os.path.dirname(__file__), 'data', 'baseline_recursions.npz')
+
+
+def inputs(hmm_type):
+  """The fixed-seed data and parameters of the tests of hmm_type."""
+  rng = np.random.RandomState(HMM_TYPES.index(hmm_type))
+  data = rng.randn(NUM_SEQUENCES, LENGTH, DATA_DIM) * 2.0
+  # the transitions keep the support of the type, with random weights
+  support = HMM(NUM_STATES, DATA_DIM, hmm_type, backend='numpy')._tp > 0
+  tp = support * rng.uniform(0.2, 1.0, (NUM_STATES, NUM_STATES))
+  tp /= np.sum(tp, axis=1, keepdims=True)
+  if hmm_type == 'left-to-right':
+    p0 = np.eye(1, NUM_STATES)
+  else:
+    p0 = rng.dirichlet(np.ones(NUM_STATES))[np.newaxis]
+  mu = rng.randn(NUM_STATES, DATA_DIM) * 2.0
+  a = rng.randn(NUM_STATES, DATA_DIM, DATA_DIM)
+  sigma = np.matmul(a, np.transpose(a, (0, 2, 1))) + np.eye(DATA_DIM)
+  return data, p0, tp, mu, sigma
+
+
+def model_of(hmm_type, recursion='sequential'):
+  """A tensorflow model with the parameters of inputs(hmm_type)."""
+  _, p0, tp, mu, sigma = inputs(hmm_type)
+  model = HMM(NUM_STATES, DATA_DIM, hmm_type, recursion=recursion)
+  model._p0, model._tp, model._mu, model._sigma = p0, tp, mu, sigma
+  model._epoch = 1
+  model._params_version += 1
+  return model
+
+
+@pytest.fixture(scope='module')
+def baseline():
+  return np.load(BASELINE)
+
+
+@pytest.mark.parametrize('hmm_type', HMM_TYPES)
+def test_recursions_match_baseline(baseline, hmm_type):
+  data = inputs(hmm_type)[0]
+  model = model_of(hmm_type)
+  alpha, c, betta, gamma, xi, posterior, log_shift, w, am = model._run(
+    [model._alpha, model._c, model._betta, model._gamma, model._xi,
+     model._posterior, model._log_shift, model._w, model._am],
+    model._data_feed(data, None))
+  ref = {key.split('/')[1]: baseline[key] for key in baseline.files
+         if key.startswith(hmm_type + '/')}
+  np.testing.assert_allclose(alpha, ref['alpha'], rtol=1e-9, atol=1e-12)
+  np.testing.assert_allclose(
+    np.log(c) + np.transpose(log_shift, (1, 0, 2)), np.log(ref['c']),
+    rtol=1e-9)
+  np.testing.assert_allclose(betta, ref['betta'], rtol=1e-9, atol=1e-12)
+  np.testing.assert_allclose(gamma, ref['gamma'], rtol=1e-9, atol=1e-12)
+  np.testing.assert_allclose(xi, ref['xi_sum'], rtol=1e-9, atol=1e-12)
+  np.testing.assert_allclose(posterior, ref['posterior'], rtol=1e-9)
+  np.testing.assert_allclose(w, ref['w'], rtol=1e-9)
+  # the best previous state of an unreachable state is arbitrary
+  reachable = np.isfinite(ref['w'][:, 1:])
+  np.testing.assert_array_equal(
+    am[:, 1:][reachable], ref['am'][:, 1:][reachable])
+
+
+@pytest.mark.parametrize('hmm_type', HMM_TYPES)
+def test_viterbi_path_matches_baseline(baseline, hmm_type):
+  data = inputs(hmm_type)[0]
+  path = model_of(hmm_type).run_viterbi(data)
+  # the baseline path repeats its first state
+  np.testing.assert_array_equal(path, baseline[hmm_type + '/path'][:, 1:])
@@ -0,0 +1,51 @@
+"""Parity of the associative scans with the sequential recursions."""
+import numpy as np
+import pytest
+
+HMM_TYPES = ('fully-connected', 'left-to-right', 'cyclic')
+BACKENDS = ('tensorflow', 'numpy')
+# odd, power of two and single frame lengths
+LENGTHS = (1, 7, 16, 33)
+
+
+def scan_and_sequential(make_model, hmm_type, backend):
+  return [make_model(3, 2, hmm_type, backend=backend, recursion=recursion)
+          for recursion in ('scan', 'sequential')]
+
+
+def assert_same_inference(scan, sequential, data):
+  np.testing.assert_allclose(
+    scan.posterior(data), sequential.posterior(data), rtol=1e-10)
+  gamma, xi = scan.predict_proba(data, return_transitions=True)
+  gamma_seq, xi_seq = sequential.predict_proba(data, return_transitions=True)
+  np.testing.assert_allclose(gamma, gamma_seq, rtol=1e-9, atol=1e-12)
+  np.testing.assert_allclose(xi, xi_seq, rtol=1e-9, atol=1e-12)
+  paths, log_prob = scan.run_viterbi(data, return_log_prob=True)
+  paths_seq, log_prob_seq = sequential.run_viterbi(
+    data, return_log_prob=True)
+  np.testing.assert_allclose(log_prob, log_prob_seq, rtol=1e-10)
+  if isinstance(paths, list):
+    for path, path_seq in zip(paths, paths_seq):
+      np.testing.assert_array_equal(path, path_seq)
+  else:
+    np.testing.assert_array_equal(paths, paths_seq)
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('hmm_type', HMM_TYPES)
+def test_scan_matches_sequential(make_model, hmm_type, backend, length):
+  data = np.random.RandomState(length).randn(2, length, 2) * 2.0
+  scan, sequential = scan_and_sequential(make_model, hmm_type, backend)
+  assert_same_inference(scan, sequential, data)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('hmm_type', HMM_TYPES)
+def test_scan_matches_sequential_on_padded_batches(make_model, hmm_type,
+                                                   backend):
+  # the variable-length sequences are padded and masked into one batch
+  rng = np.random.RandomState(4)
+  data = [rng.randn(length, 2) * 2.0 for length in (16, 1, 7, 33, 8)]
+  scan, sequential = scan_and_sequential(make_model, hmm_type, backend)
+  assert_same_inference(scan, sequential, data)
@@ -0,0 +1,60 @@
+"""The shards of the sources and the sharded expectation step of fit."""
+import numpy as np
+import pytest
+from kesmarag.ml.hmm import HMM
+from kesmarag.ml.hmm import sources
+
+
+def training_data(seed=0):
+  rng = np.random.RandomState(seed)
+  states = rng.randint(0, 2, (20, 25, 1))
+  return rng.randn(20, 25, 2) + 4.0 * states
+
+
+def make_source(kind, data, tmpdir):
+  if kind == 'array':
+    return sources.as_source(data)
+  if kind == 'ragged':
+    return sources.as_source([x[:5 + i % 20] for i, x in enumerate(data)])
+  if kind == 'shards':
+    paths = [str(tmpdir.join('shard%d.npy' % i)) for i in range(3)]
+    for path, part in zip(paths, np.array_split(data, 3)):
+      np.save(path, part)
+    return sources.as_source(paths)
+  return sources.as_source(lambda: (data[i:i + 3] for i in range(0, 20, 3)))
+
+
+def first_frames(source):
+  return np.concatenate([batch[:, 0, 0] for batch, _ in source.chunks(4)])
+
+
+@pytest.mark.parametrize('count', (1, 2, 3, 5))
+@pytest.mark.parametrize('kind', ('array', 'ragged', 'shards', 'stream'))
+def test_shards_cover_every_sequence_once(kind, count, tmpdir):
+  data = training_data()
+  source = make_source(kind, data, tmpdir)
+  frames = np.concatenate(
+    [first_frames(source.shard(index, count)) for index in range(count)])
+  np.testing.assert_array_equal(np.sort(frames), np.sort(data[:, 0, 0]))
+
+
+def fit_params(data, **kwargs):
+  model = HMM(2, 2)
+  model.fit(data, max_steps=4, seed=0, **kwargs)
+  return [model.p0, model.tp, model.mu, model.sigma], model.history
+
+
+@pytest.mark.parametrize('kind', ('array', 'ragged'))
+def test_sharded_e_step_matches_single_process(kind, tmpdir):
+  data = make_source(kind, training_data(), tmpdir)
+  validation = training_data(1)[:4]
+  params, history = fit_params(
+    data, eval_every=2, validation_data=validation)
+  sharded, sharded_history = fit_params(
+    data, eval_every=2, validation_data=validation, e_step_jobs=2)
+  for value, expected in zip(sharded, params):
+    np.testing.assert_allclose(value, expected, rtol=1e-10, atol=1e-12)
+  for step, expected in zip(sharded_history['runs'][0]['steps'],
+                            history['runs'][0]['steps']):
+    np.testing.assert_allclose(
+      step['log_likelihood'], expected['log_likelihood'], rtol=1e-12)
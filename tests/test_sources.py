@@ -0,0 +1,70 @@
+"""Out-of-core training on memory-mapped arrays, .npy shards and streams."""
+import numpy as np
+import pytest
+from kesmarag.ml.hmm import HMM
+from kesmarag.ml.hmm import sources
+
+
+def training_data(seed=0):
+  rng = np.random.RandomState(seed)
+  states = rng.randint(0, 2, (24, 30, 1))
+  return rng.randn(24, 30, 2) + 4.0 * states
+
+
+def fit_params(data, **kwargs):
+  model = HMM(2, 2)
+  model.fit(data, max_steps=4, seed=0, **kwargs)
+  return [model.p0, model.tp, model.mu, model.sigma]
+
+
+@pytest.fixture(scope='module')
+def in_memory():
+  return fit_params(training_data())
+
+
+@pytest.mark.parametrize('kind', ('memmap', 'shards', 'stream'))
+def test_out_of_core_fit_matches_in_memory_fit(in_memory, kind, tmpdir):
+  data = training_data()
+  # the sequences come in the same order in chunks, so the initialization
+  # draws the same random numbers
+  if kind == 'memmap':
+    path = str(tmpdir.join('data.npy'))
+    np.save(path, data)
+    params = fit_params(np.load(path, mmap_mode='r'), chunk_size=5)
+  elif kind == 'shards':
+    paths = [str(tmpdir.join('shard%d.npy' % i)) for i in range(3)]
+    for path, part in zip(paths, np.array_split(data, 3)):
+      np.save(path, part)
+    params = fit_params(paths)
+  else:
+    params = fit_params(lambda: (data[i:i + 7] for i in range(0, 24, 7)))
+  for value, expected in zip(params, in_memory):
+    np.testing.assert_allclose(value, expected, rtol=1e-8, atol=1e-10)
+
+
+def test_shard_source_limits_files_to_their_bounds(tmpdir):
+  data = training_data()
+  paths = [str(tmpdir.join('shard%d.npy' % i)) for i in range(2)]
+  np.save(paths[0], data[:10])
+  np.save(paths[1], data[10:])
+  source = sources.ShardSource(paths, bounds=[(2, 5), (0, 4)])
+  assert source.num_sequences == 7
+  batch = np.concatenate([batch for batch, _ in source.chunks(2)])
+  np.testing.assert_array_equal(
+    batch, np.concatenate([data[2:5], data[10:14]]))
+
+
+@pytest.mark.parametrize('num_frames', (1, 50, 10000))
+def test_sample_frames_draws_frames_of_the_data(num_frames):
+  data = [np.arange(length * 2.0).reshape(length, 2) + 1000.0 * i
+          for i, length in enumerate((30, 5, 17))]
+  np.random.seed(0)
+  frames, positions = sources.sample_frames(
+    sources.as_source(data), num_frames, chunk_size=2)
+  all_frames = np.concatenate(data)
+  assert len(frames) == min(num_frames, len(all_frames))
+  # the padding is never sampled and no frame is sampled twice
+  rows = {tuple(frame) for frame in all_frames}
+  assert all(tuple(frame) in rows for frame in frames)
+  assert len({tuple(frame) for frame in frames}) == len(frames)
+  assert np.all((positions >= 0.0) & (positions < 1.0))
@@ -0,0 +1,58 @@
+"""The shuffled passes and the fits of stepwise EM."""
+import numpy as np
+import pytest
+from kesmarag.ml.hmm import HMM
+from kesmarag.ml.hmm import sources
+
+
+def source_of(kind, tmpdir):
+  rng = np.random.RandomState(5)
+  if kind == 'array':
+    return sources.as_source(rng.randn(23, 4, 1))
+  if kind == 'ragged':
+    return sources.as_source(
+      [rng.randn(1 + i % 9, 1) for i in range(23)])
+  paths = []
+  for i, num in enumerate((10, 13)):
+    paths.append(str(tmpdir.join('shard%d.npy' % i)))
+    np.save(paths[-1], rng.randn(num, 4, 1))
+  return sources.as_source(paths)
+
+
+def first_frames(chunks):
+  # the first frame of every sequence of a pass, in the order of the pass
+  return np.concatenate([batch[:, 0, 0] for batch, _ in chunks])
+
+
+@pytest.mark.parametrize('kind', ('array', 'ragged', 'shards'))
+def test_shuffled_chunks_cover_the_data_in_a_new_order(kind, tmpdir):
+  source = source_of(kind, tmpdir)
+  in_order = first_frames(source.chunks(5))
+  np.random.seed(0)
+  passes = [first_frames(source.chunks(5, shuffle=True)) for _ in range(3)]
+  for frames in passes:
+    np.testing.assert_array_equal(np.sort(frames), np.sort(in_order))
+  assert not all(np.array_equal(frames, passes[0]) for frames in passes[1:])
+
+
+def test_stream_chunks_keep_their_order():
+  data = np.random.RandomState(6).randn(12, 3, 1)
+  source = sources.as_source(lambda: (data[i:i + 4] for i in range(0, 12, 4)))
+  np.testing.assert_array_equal(
+    first_frames(source.chunks(4, shuffle=True)), data[:, 0, 0])
+
+
+def test_stepwise_fit_on_ragged_data():
+  rng = np.random.RandomState(7)
+  data = [rng.randn(5 + i % 40, 1) + 6.0 * (rng.rand() < 0.5)
+          for i in range(200)]
+  fits = []
+  for _ in range(2):
+    model = HMM(2, 1, covariance_type='diag')
+    model.fit(data, batch_size=20, stepwise=True, max_steps=2, seed=3)
+    fits.append(model)
+  # the random order of the passes comes from the seed
+  np.testing.assert_array_equal(fits[0].mu, fits[1].mu)
+  np.testing.assert_allclose(np.sort(fits[0].mu[:, 0]), [0.0, 6.0], atol=0.3)
+  steps = fits[0].history['runs'][0]['steps']
+  assert [step['updates'] for step in steps] == [10, 10]
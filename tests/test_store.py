@@ -0,0 +1,123 @@
+"""The model file format and the cache of loaded models."""
+import os
+import numpy as np
+import pytest
+from kesmarag.ml.hmm import HMM
+from kesmarag.ml.hmm import store
+
+COVARIANCE_TYPES = ('full', 'diag', 'spherical', 'tied')
+
+
+def saved_model(make_model, tmpdir, name='model.hmm', **kwargs):
+  model = make_model(3, 2, 'cyclic', backend='numpy', **kwargs)
+  path = str(tmpdir.join(name))
+  model.save_model(path)
+  return model, path
+
+
+@pytest.mark.parametrize('mmap', (True, False))
+@pytest.mark.parametrize('covariance_type', COVARIANCE_TYPES)
+def test_round_trip(make_model, tmpdir, covariance_type, mmap):
+  model, path = saved_model(make_model, tmpdir,
+                            covariance_type=covariance_type)
+  loaded = HMM.load(path, mmap=mmap, cache=False)
+  assert loaded.covariance_type == covariance_type
+  for name in ('_p0', '_tp', '_mu', '_sigma'):
+    np.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+    # the memory-mapped arrays are read-only views of the file
+    assert getattr(loaded, name).flags.writeable != mmap
+  data = np.random.RandomState(3).randn(2, 9, 2)
+  np.testing.assert_allclose(
+    loaded.posterior(data), model.posterior(data), rtol=1e-12)
+  np.testing.assert_array_equal(
+    loaded.run_viterbi(data), model.run_viterbi(data))
+
+
+def test_load_model_into_a_built_model(make_model, tmpdir):
+  model, path = saved_model(make_model, tmpdir, covariance_type='diag')
+  target = HMM(3, 2, 'cyclic', covariance_type='diag')
+  target.load_model(path)
+  np.testing.assert_array_equal(target.mu, model.mu)
+  with pytest.raises(ValueError):
+    HMM(3, 2, 'cyclic', covariance_type='full').load_model(path)
+
+
+def test_rejects_a_bad_magic(make_model, tmpdir):
+  _, path = saved_model(make_model, tmpdir)
+  with open(path, 'r+b') as f:
+    f.write(b'\x93NOPE')
+  assert not store.is_model_file(path)
+  with pytest.raises(ValueError, match='is not a model file'):
+    store.read_model(path)
+
+
+def test_rejects_a_newer_version(make_model, tmpdir):
+  _, path = saved_model(make_model, tmpdir)
+  with open(path, 'r+b') as f:
+    _, _, header_len = store._PREAMBLE.unpack(f.read(store._PREAMBLE.size))
+    f.seek(0)
+    f.write(store._PREAMBLE.pack(
+      store.MAGIC, store.FORMAT_VERSION + 1, header_len))
+  with pytest.raises(ValueError, match='newer'):
+    store.read_model(path)
+
+
+def test_load_model_of_a_legacy_npz(make_model, tmpdir):
+  model = make_model(3, 2)
+  path = str(tmpdir.join('legacy.npz'))
+  # the file of the earlier versions of save_model
+  np.savez(path, p0=model._p0, tp=model._tp, mu=model._mu, sigma=model._sigma)
+  loaded = HMM(3, 2, backend='numpy')
+  loaded.load_model(path)
+  for name in ('p0', 'tp', 'mu', 'sigma'):
+    np.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+
+
+def test_cache_reloads_a_replaced_file(make_model, tmpdir):
+  cache = store.ModelCache()
+  _, path = saved_model(make_model, tmpdir)
+  first = HMM.load(path, cache=cache)
+  assert HMM.load(path, cache=cache) is first
+  stat = os.stat(path)
+  replacement, _ = saved_model(make_model, tmpdir, seed=1)
+  # the same size, so only the modification time tells the files apart
+  os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+  second = HMM.load(path, cache=cache)
+  assert second is not first
+  np.testing.assert_array_equal(second.mu, replacement.mu)
+  # the model of the replaced file is dropped
+  assert len(cache) == 1
+
+
+def cached_files(tmpdir, cache, names, nbytes=100):
+  # gets files through the cache, with loads of nbytes bytes
+  loaded = {}
+  for name in names:
+    path = str(tmpdir.join(name))
+    if not os.path.exists(path):
+      tmpdir.join(name).write(name)
+    loaded[name] = cache.get(path, lambda path: (object(), nbytes))
+  return loaded
+
+
+def cached_names(cache):
+  return sorted(os.path.basename(key[0]) for key in cache._models)
+
+
+@pytest.mark.parametrize('bounds', ({'max_bytes': 250}, {'max_models': 2}))
+def test_cache_evicts_the_least_recently_used(tmpdir, bounds):
+  cache = store.ModelCache(**bounds)
+  first = cached_files(tmpdir, cache, ('a', 'b', 'a'))
+  assert cached_files(tmpdir, cache, ('a',))['a'] is first['a']
+  cached_files(tmpdir, cache, ('c',))
+  assert cached_names(cache) == ['a', 'c']
+  assert cache.nbytes == 200
+
+
+def test_cache_keeps_the_most_recent_model(tmpdir):
+  cache = store.ModelCache(max_bytes=250)
+  cached_files(tmpdir, cache, ('a', 'b'))
+  cached_files(tmpdir, cache, ('c',), nbytes=1000)
+  assert cached_names(cache) == ['c']
+  cache.clear()
+  assert len(cache) == 0 and cache.nbytes == 0